@@ -0,0 +1,686 @@
+#!/usr/bin/env python
+# Micro-benchmarks for the search engine and the game states, and a reproducible
+# benchmark suite whose results can be saved and compared against a baseline:
+#
+#   python benchmarks.py --suite results.json --baseline baseline.json
+from math import exp, log, sqrt
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+
+from framework import Node, NodeTree, ArrayTree, TranspositionTree, Determinizer, ismcts, \
+    ismcts_search, parallel_ismcts, pimc, popcount
+from knockout_whist import KnockoutWhistState
+from president import PresidentGameState, reference_moves, ranks_held, HIGH_CARDS
+from tournament import tournament
+
+
+def president_positions(num_games=200, seed=0):
+    """ Return every state reached in num_games random games of President.
+    """
+    rng_state = random.getstate()
+    random.seed(seed)
+    positions = []
+    for game_num in range(num_games):
+        state = PresidentGameState()
+        state._deal()
+        while state.get_moves():
+            positions.append(state.clone())
+            state.do_move(random.choice(state.get_moves()))
+    random.setstate(rng_state)
+    return positions
+
+
+def time_move_generator(generate, positions, repeats=3):
+    """ Return (calls per second, moves per second) for generating the moves of every position.
+    """
+    best = None
+    num_moves = 0
+    for repeat in range(repeats):
+        num_moves = 0
+        start = time.time()
+        for state in positions:
+            num_moves += len(generate(state))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(positions) / best, num_moves / best
+
+
+def bench_move_generation():
+    """ Compare PresidentGameState.get_moves with the original list-scanning generator.
+    """
+    positions = president_positions()
+    for name, generate in (("reference_moves", reference_moves),
+                           ("get_moves", PresidentGameState.get_moves)):
+        calls, moves = time_move_generator(generate, positions)
+        print "%-16s %9.0f calls/sec %10.0f moves/sec" % (name, calls, moves)
+
+
+def president_openings(num_games=20, seed=0):
+    """ Return the opening state of num_games deals of President. These have
+        the widest roots, with dozens of singles, pairs and straights to lead.
+    """
+    rng_state = random.getstate()
+    random.seed(seed)
+    openings = []
+    for game_num in range(num_games):
+        state = PresidentGameState()
+        state._deal()
+        openings.append(state)
+    random.setstate(rng_state)
+    return openings
+
+
+def scan_untried_moves(node, legal_moves):
+    """ The original list-scanning Node.get_untried_moves, for comparison.
+    """
+    tried_moves = [child.move for child in node.child_nodes.itervalues()]
+    return [move for move in legal_moves if move not in tried_moves]
+
+
+def scan_select_child(node, legal_moves, exploration=0.7):
+    """ The original list-scanning Node.ucb_select_child, for comparison.
+    """
+    legal_children = [child for child in node.child_nodes.itervalues() if
+                      child.move in legal_moves]
+    s = max(legal_children, key=lambda c: float(c.wins) / float(
+        c.visits) + exploration * sqrt(log(c.avails) / float(c.visits)))
+    for child in legal_children:
+        child.avails += 1
+    return s
+
+
+def bench_wide_root(itermax=1000, repeats=200):
+    """ Time the tree policy at fully expanded President opening roots, using
+        the dictionary-indexed children of Node and the original list scans,
+        then time whole ismcts searches from the same roots.
+    """
+    openings = president_openings()
+    roots = []
+    trees = []
+    for state in openings:
+        root = Node()
+        tree = ArrayTree()
+        for move in state.get_legal_moves():
+            child = root.add_child(move, state.player_to_move)
+            child.visits = 1
+            tree.visits[tree.add_child(tree.root, move, state.player_to_move)] = 1
+        roots.append((root, state.get_legal_moves()))
+        trees.append((tree, state.get_legal_moves()))
+    print "%.1f moves per root" % (sum(len(moves) for root, moves in roots) / float(len(roots)))
+
+    for name, untried, select in (
+            ("list scan", scan_untried_moves, scan_select_child),
+            ("dict index", Node.get_untried_moves, Node.ucb_select_child)):
+        start = time.time()
+        for repeat in range(repeats):
+            for root, moves in roots:
+                untried(root, moves)
+                select(root, moves)
+        elapsed = time.time() - start
+        print "%-10s %9.0f tree policy steps/sec" % (name, repeats * len(roots) / elapsed)
+
+    start = time.time()
+    for repeat in range(repeats):
+        for tree, moves in trees:
+            tree.get_untried_moves(tree.root, moves)
+            tree.select_child(tree.root, moves, 0.7)
+    elapsed = time.time() - start
+    print "%-10s %9.0f tree policy steps/sec" % ("ArrayTree", repeats * len(trees) / elapsed)
+
+    start = time.time()
+    for state in openings:
+        ismcts(rootstate=state, itermax=itermax, quiet=True)
+    elapsed = time.time() - start
+    print "ismcts     %9.0f iterations/sec" % (itermax * len(openings) / elapsed)
+
+
+def node_tree_bytes(tree):
+    """ Return the memory used by the Node objects of a NodeTree, in bytes.
+    """
+    total = 0
+    nodes = [tree.root]
+    while nodes:
+        node = nodes.pop()
+        total += sys.getsizeof(node) + sys.getsizeof(node.__dict__) + \
+                 sys.getsizeof(node.child_nodes)
+        nodes.extend(node.child_nodes.itervalues())
+    return total
+
+
+def array_tree_bytes(tree):
+    """ Return the memory used by the arrays of an ArrayTree, in bytes.
+    """
+    return sum(a.buffer_info()[1] * a.itemsize for a in (
+        tree.wins, tree.visits, tree.avails, tree.moves, tree.players,
+        tree.parents, tree.first_child, tree.next_sibling))
+
+
+def bench_tree_store(itermax=2000):
+    """ Compare the memory per node and the iterations/sec of ismcts for the
+        Node tree and the array-backed tree, searching from President openings.
+    """
+    openings = president_openings(num_games=5)
+    for name, new_tree, tree_bytes in (("NodeTree", NodeTree, node_tree_bytes),
+                                       ("ArrayTree", ArrayTree, array_tree_bytes)):
+        nodes = 0
+        total_bytes = 0
+        elapsed = 0.0
+        for state in openings:
+            tree = new_tree()
+            start = time.time()
+            ismcts(rootstate=state, itermax=itermax, quiet=True, tree=tree)
+            elapsed += time.time() - start
+            nodes += tree.node_count
+            total_bytes += tree_bytes(tree)
+        print "%-10s %6.0f bytes/node %9.0f iterations/sec" % (
+            name, total_bytes / float(nodes), itermax * len(openings) / elapsed)
+
+
+def bench_undo(itermax=2000):
+    """ Compare the iterations/sec of ismcts when it clones the root state every
+        iteration and when it plays in one scratch state and undoes the moves.
+    """
+    random.seed(0)
+    whist = KnockoutWhistState(4)
+    for name, state in (("President", president_openings(num_games=1)[0]),
+                        ("Knockout Whist", whist)):
+        for mode, can_undo in (("clone", False), ("undo", True)):
+            state.can_undo = can_undo
+            start = time.time()
+            ismcts(rootstate=state, itermax=itermax, quiet=True)
+            elapsed = time.time() - start
+            print "%-14s %-5s %9.0f iterations/sec" % (name, mode, itermax / elapsed)
+        del state.can_undo
+
+
+def bench_determinize(repeats=20000):
+    """ Compare the determinizations/sec of clone_and_randomize with those of a
+        Determinizer dealing fresh hands, and cycling through a batch of 100.
+    """
+    random.seed(0)
+    whist = KnockoutWhistState(4)
+    for name, state in (("President", president_openings(num_games=1)[0]),
+                        ("Knockout Whist", whist)):
+        observer = state.player_to_move
+        start = time.time()
+        for repeat in xrange(repeats):
+            state.clone_and_randomize(observer)
+        elapsed = time.time() - start
+        print "%-14s %-18s %9.0f determinizations/sec" % (
+            name, "clone_and_randomize", repeats / elapsed)
+        for mode, count in (("Determinizer", None), ("Determinizer x100", 100)):
+            start = time.time()
+            determinizer = Determinizer(state, observer, count)
+            for repeat in xrange(repeats):
+                determinizer.randomize(state.clone())
+            elapsed = time.time() - start
+            print "%-14s %-18s %9.0f determinizations/sec" % (name, mode, repeats / elapsed)
+
+
+def bench_transpositions(time_budget=0.05, max_games=100, itermax=3000):
+    """ Report the table hit rate and the iterations/sec of a TranspositionTree,
+        then play a tournament between searches with and without transpositions
+        given the same time per move, which measures playing strength per CPU-second.
+    """
+    for name, state in (("President", president_openings(num_games=1)[0]),
+                        ("Knockout Whist", KnockoutWhistState(4))):
+        for tree in (NodeTree(), TranspositionTree()):
+            random.seed(0)
+            result = ismcts_search(state, itermax, quiet=True, tree=tree)
+            print "%-14s %-17s %9.0f iterations/sec %6i nodes" % (
+                name, tree.__class__.__name__, result.iterations_per_second, result.tree_size),
+            if tree.transpositions:
+                print "hit rate %.3f" % tree.hit_rate(),
+            print
+
+    for game in ("president", "whist"):
+        print "%-14s %s" % (game, tournament({"time_budget": time_budget, "tree": "transposition"},
+                                             {"time_budget": time_budget}, game=game,
+                                             max_games=max_games, quiet=True))
+
+
+def bench_node_budget(time_budget=5.0, max_nodes=2000):
+    """ Compare the peak tree size and the iterations/sec of time-budgeted searches
+        from a President opening with and without a node budget.
+    """
+    state = president_openings(num_games=1)[0]
+    for new_tree in (NodeTree, ArrayTree):
+        for budget in (None, max_nodes):
+            random.seed(0)
+            result = ismcts_search(state, time_budget=time_budget, quiet=True, tree=new_tree(),
+                                   max_nodes=budget)
+            print "%-10s budget %-5s %9.0f iterations/sec %6i nodes %6i peak" % (
+                new_tree.__name__, budget, result.iterations_per_second, result.tree_size,
+                result.peak_tree_size)
+
+
+def bench_batched_rollouts(num_rollouts=2000, itermax=3000, batch_sizes=(16, 64, 256)):
+    """ Compare the rollouts/sec of President and of Knockout Whist with 2 to 7
+        players played one at a time and in batches, and the iterations/sec of
+        leaf-batched ismcts.
+    """
+    random.seed(0)
+    president = president_openings(num_games=1)[0]
+    games = [("President", president)] + [
+        ("Whist %i players" % players, KnockoutWhistState(players)) for players in range(2, 7 + 1)]
+    for name, state in games:
+        start = time.time()
+        for i in range(num_rollouts):
+            state.clone().do_random_rollout(random)
+        print "%-16s sequential %9.0f rollouts/sec" % (name, num_rollouts / (time.time() - start))
+        for batch_size in batch_sizes:
+            start = time.time()
+            for i in range(num_rollouts // batch_size):
+                state.do_random_rollouts([state.clone() for b in range(batch_size)], random)
+            print "%-16s batch %-5i %9.0f rollouts/sec" % (
+                name, batch_size, num_rollouts // batch_size * batch_size / (time.time() - start))
+
+    for name, state in (("President", president), ("Knockout Whist", KnockoutWhistState(4))):
+        for batch_size in (None,) + tuple(batch_sizes):
+            result = ismcts_search(state, itermax=itermax, quiet=True, batch_size=batch_size)
+            print "%-14s ismcts batch %-5s %9.0f iterations/sec" % (
+                name, batch_size, result.iterations_per_second)
+
+
+def bench_rollout_depth(time_budget=0.05, max_games=100, itermax=2000, depths=(4, 16)):
+    """ Report the iterations/sec of ismcts with full rollouts and with rollouts
+        cut short at each of depths moves and scored by evaluate(), then play
+        tournaments between them given the same time per move, which measures
+        playing strength per CPU-second.
+    """
+    for name, state in (("President", president_openings(num_games=1)[0]),
+                        ("Knockout Whist", KnockoutWhistState(4))):
+        for depth in (None,) + tuple(depths):
+            random.seed(0)
+            result = ismcts_search(state, itermax, quiet=True, rollout_depth=depth, profile=True)
+            print "%-14s depth %-4s %9.0f iterations/sec %5.1f moves/rollout" % (
+                name, depth, result.iterations_per_second, result.stats.average_rollout_length())
+
+    for game in ("president", "whist"):
+        for depth in depths:
+            print "%-14s depth %-4s %s" % (game, depth, tournament(
+                {"time_budget": time_budget, "rollout_depth": depth}, {"time_budget": time_budget},
+                game=game, max_games=max_games, quiet=True))
+
+
+# The features of PresidentGameState.evaluate, named as in EVALUATION_WEIGHTS
+EVALUATION_FEATURES = ("cards", "ranks", "high_cards", "to_move")
+
+
+def evaluation_features(state, player):
+    """ Return the features that PresidentGameState.evaluate weighs, for player,
+        in the order of EVALUATION_FEATURES.
+    """
+    mine = state.player_hands[player]
+    theirs = state.player_hands[1 - player]
+    return [popcount(theirs) - popcount(mine),
+            ranks_held(theirs) - ranks_held(mine),
+            popcount(mine & HIGH_CARDS) - popcount(theirs & HIGH_CARDS),
+            1 if state.player_to_move == player else -1]
+
+def fit_evaluation_weights(num_positions=20000, iterations=20, seed=0):
+    """ Fit the EVALUATION_WEIGHTS of PresidentGameState.evaluate: a logistic
+        regression, by Newton's method, of the result of one random rollout from
+        each of num_positions positions on evaluation_features. The positions are
+        taken at a random point of random games, for a random player. Return
+        {feature: weight}.
+    """
+    rng_state = random.getstate()
+    random.seed(seed)
+    samples = []
+    while len(samples) < num_positions:
+        state = new_president_game()
+        state.do_random_rollout(random, max_moves=random.randrange(60))
+        if state.player_hands[0] and state.player_hands[1]:
+            player = random.randrange(2)
+            features = evaluation_features(state, player)
+            state.do_random_rollout(random)
+            samples.append((features, state.get_result(player)))
+    random.setstate(rng_state)
+
+    size = len(EVALUATION_FEATURES)
+    weights = [0.0] * size
+    for iteration in range(iterations):
+        gradient = [0.0] * size
+        hessian = [[0.0] * size for i in range(size)]
+        for features, result in samples:
+            p = 1.0 / (1.0 + exp(-sum(w * x for (w, x) in zip(weights, features))))
+            for i in range(size):
+                gradient[i] += (result - p) * features[i]
+                for j in range(size):
+                    hessian[i][j] += p * (1 - p) * features[i] * features[j]
+        # Solve hessian * step = gradient by Gaussian elimination
+        rows = [hessian[i] + [gradient[i]] for i in range(size)]
+        for i in range(size):
+            pivot = max(range(i, size), key=lambda r: abs(rows[r][i]))
+            rows[i], rows[pivot] = rows[pivot], rows[i]
+            for r in range(i + 1, size):
+                factor = rows[r][i] / rows[i][i]
+                rows[r] = [a - factor * b for (a, b) in zip(rows[r], rows[i])]
+        step = [0.0] * size
+        for i in reversed(range(size)):
+            step[i] = (rows[i][size] - sum(rows[i][j] * step[j] for j in range(i + 1, size))) / rows[i][i]
+        weights = [w + s for (w, s) in zip(weights, step)]
+    return dict(zip(EVALUATION_FEATURES, weights))
+
+
+def president_endgames(num_positions=50, max_cards=14, seed=0):
+    """ Play random President games until the hands hold at most max_cards cards
+        between them, and return num_positions of the positions reached that have
+        a choice of moves.
+    """
+    rng_state = random.getstate()
+    random.seed(seed)
+    positions = []
+    while len(positions) < num_positions:
+        state = new_president_game()
+        while state.get_legal_moves() and \
+                popcount(state.player_hands[0]) + popcount(state.player_hands[1]) > max_cards:
+            state.do_move(state.get_random_move(random))
+        if len(state.get_legal_moves()) > 1:
+            positions.append(state)
+    random.setstate(rng_state)
+    return positions
+
+
+def bench_endgame(num_positions=50, itermax=1000, endgame_size=12, determinizations=20,
+                  time_budget=0.05, max_games=100):
+    """ Compare ismcts, ismcts solving the leaves of at most endgame_size cards and
+        PIMC on President endgames: how often each chooses a move that wins
+        against the actual cards, of the positions that have one, and the time
+        they take per move. Then play a tournament between ismcts with and
+        without the solver, given the same time per move.
+    """
+    positions = president_endgames(num_positions)
+    # The moves that win against the actual cards
+    winning = []
+    for state in positions:
+        moves = set()
+        for move in state.get_legal_moves():
+            child = state.clone()
+            child.do_move(move)
+            if child.solve()[state.player_to_move]:
+                moves.add(move)
+        winning.append(moves)
+
+    searches = (("ismcts", lambda state: ismcts(state, itermax, quiet=True)),
+                ("ismcts+solver", lambda state: ismcts(state, itermax, quiet=True,
+                                                       endgame_size=endgame_size)),
+                ("pimc", lambda state: pimc(state, determinizations)))
+    for name, search in searches:
+        random.seed(0)
+        found = 0
+        start = time.time()
+        for state, moves in zip(positions, winning):
+            move = search(state)
+            if move in moves:
+                found += 1
+        elapsed = time.time() - start
+        print "%-14s %3i/%i winning moves found %8.4f sec/move" % (
+            name, found, sum(1 for moves in winning if moves), elapsed / len(positions))
+
+    print "president solver %s" % tournament(
+        {"time_budget": time_budget, "endgame_size": endgame_size}, {"time_budget": time_budget},
+        game="president", max_games=max_games, quiet=True)
+
+
+def bench_parallel_scaling(max_workers=None, itermax=4000):
+    """ Report the iterations/sec of parallel_ismcts with 1 to max_workers worker
+        processes (by default one per CPU), for President and Knockout Whist.
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    random.seed(0)
+    whist = KnockoutWhistState(4)
+    for name, state in (("President", president_openings(num_games=1)[0]),
+                        ("Knockout Whist", whist)):
+        for workers in range(1, max_workers + 1):
+            pool = multiprocessing.Pool(workers)
+            try:
+                # Warm up the workers before timing
+                parallel_ismcts(state, workers, workers=workers, pool=pool)
+                start = time.time()
+                parallel_ismcts(state, itermax, workers=workers, pool=pool)
+                elapsed = time.time() - start
+            finally:
+                pool.terminate()
+            print "%-14s %2i workers %9.0f iterations/sec" % (name, workers, itermax / elapsed)
+
+
+# The points of a game that the suite takes positions from, as a fraction of
+# the moves of the game that have been played
+GAME_PHASES = (("opening", 0.0), ("midgame", 0.5), ("endgame", 0.85))
+
+
+def game_phase_positions(new_game, num_games, seed):
+    """ Play num_games random games, starting each from new_game(), and return
+        {phase: [state]} with the state at each of GAME_PHASES of every game.
+    """
+    rng_state = random.getstate()
+    random.seed(seed)
+    positions = dict((phase, []) for (phase, fraction) in GAME_PHASES)
+    for game_num in range(num_games):
+        state = new_game()
+        history = [state.clone()]
+        while state.get_legal_moves():
+            state.do_move(random.choice(state.get_legal_moves()))
+            history.append(state.clone())
+        # The last state is the end of the game, which has no moves
+        for phase, fraction in GAME_PHASES:
+            positions[phase].append(history[int(fraction * (len(history) - 2))])
+    random.setstate(rng_state)
+    return positions
+
+
+def new_president_game():
+    state = PresidentGameState()
+    state._deal()
+    return state
+
+
+def suite_corpora(num_games=5, seed=0):
+    """ Return the fixed-seed corpora of the suite as a list of (name, [state]):
+        President and Knockout Whist with 2 to 7 players, at each of GAME_PHASES.
+    """
+    games = [("president", new_president_game)] + [
+        ("whist%i" % players, lambda players=players: KnockoutWhistState(players))
+        for players in range(2, 7 + 1)]
+    corpora = []
+    for game_num, (game, new_game) in enumerate(games):
+        positions = game_phase_positions(new_game, num_games, seed + game_num)
+        for phase, fraction in GAME_PHASES:
+            corpora.append(("%s/%s" % (game, phase), positions[phase]))
+    return corpora
+
+
+def time_calls(call, positions, repeats):
+    """ Return the best rate, in calls per second, of calling call on every position.
+    """
+    best = None
+    for repeat in range(repeats):
+        start = time.time()
+        for state in positions:
+            call(state)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(positions) / max(best, 1e-9)
+
+
+def bench_corpus(positions, itermax, seed, repeats=200):
+    """ Return the suite's measurements for one corpus as a dictionary.
+    """
+    generate = positions[0].__class__.get_moves
+    calls, moves = time_move_generator(generate, positions * repeats)
+    results = {
+        "move_generation_calls_per_sec": calls,
+        "moves_per_sec": moves,
+        "clones_per_sec": time_calls(lambda state: state.clone(), positions * repeats, 3),
+        "determinizations_per_sec": time_calls(
+            lambda state: state.clone_and_randomize(state.player_to_move),
+            positions * repeats, 3),
+    }
+
+    random.seed(seed)
+    iterations = 0
+    nodes = 0
+    total_bytes = 0
+    peak_bytes = 0
+    elapsed = 0.0
+    for state in positions:
+        if len(state.get_legal_moves()) < 2:
+            continue
+        tree = NodeTree()
+        start = time.time()
+        result = ismcts_search(state, itermax, quiet=True, tree=tree)
+        elapsed += time.time() - start
+        iterations += result.iterations
+        nodes += tree.node_count
+        # A NodeTree only grows, so its final size is the peak of its search
+        tree_bytes = node_tree_bytes(tree)
+        total_bytes += tree_bytes
+        peak_bytes = max(peak_bytes, tree_bytes)
+    if iterations:
+        results["iterations_per_sec"] = iterations / elapsed
+        results["tree_bytes_per_node"] = total_bytes / float(nodes)
+        results["peak_tree_bytes"] = peak_bytes
+        results["search_rss_kb"] = search_rss_kb(positions, itermax, seed)
+    return results
+
+
+def _search_rss_worker(args):
+    """ Run the searches of bench_corpus, and return how far they raised the peak
+        resident set size of the process, in kilobytes.
+    """
+    positions, itermax, seed = args
+    random.seed(seed)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for state in positions:
+        if len(state.get_legal_moves()) >= 2:
+            ismcts_search(state, itermax, quiet=True, tree=NodeTree())
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+def search_rss_kb(positions, itermax, seed):
+    """ Return the growth in peak resident set size, in kilobytes, of running the
+        searches of bench_corpus in a fresh process, so that the memory of the
+        rest of the benchmarks doesn't count.
+    """
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(_search_rss_worker, [(positions, itermax, seed)])
+    finally:
+        pool.terminate()
+
+
+# Whether a bigger value of each measurement is better, for compare_results
+HIGHER_IS_BETTER = {
+    "move_generation_calls_per_sec": True,
+    "moves_per_sec": True,
+    "clones_per_sec": True,
+    "determinizations_per_sec": True,
+    "iterations_per_sec": True,
+    "tree_bytes_per_node": False,
+    "peak_tree_bytes": False,
+    "search_rss_kb": False,
+}
+
+
+def run_suite(itermax=500, num_games=5, seed=0, quiet=False):
+    """ Run the benchmark suite and return its results as a dictionary that can
+        be saved as JSON.
+    """
+    results = {}
+    for name, positions in suite_corpora(num_games, seed):
+        if not quiet:
+            print "%-20s" % name,
+            sys.stdout.flush()
+        results[name] = bench_corpus(positions, itermax, seed)
+        if not quiet:
+            print " ".join("%s=%.4g" % item for item in sorted(results[name].iteritems()))
+    return {
+        "settings": {"itermax": itermax, "num_games": num_games, "seed": seed},
+        "platform": {"python": platform.python_version(), "machine": platform.machine(),
+                     "processor": platform.processor()},
+        "results": results,
+    }
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """ Compare suite results with the baseline results of an earlier run.
+        Return a list of (corpus, measurement, baseline value, value, ratio) for
+        every measurement that is worse by more than the tolerance, as a fraction.
+    """
+    if results["settings"] != baseline["settings"]:
+        raise Exception("Can't compare suite results with different settings: %s and %s" % (
+            results["settings"], baseline["settings"]))
+    regressions = []
+    for name, measurements in sorted(results["results"].iteritems()):
+        for measurement, value in sorted(measurements.iteritems()):
+            old_value = baseline["results"].get(name, {}).get(measurement)
+            if not old_value:
+                continue
+            ratio = value / float(old_value)
+            if HIGHER_IS_BETTER[measurement]:
+                worse = ratio < 1 - tolerance
+            else:
+                worse = ratio > 1 + tolerance
+            if worse:
+                regressions.append((name, measurement, old_value, value, ratio))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the search engine and the games.")
+    parser.add_argument("--suite", metavar="RESULTS",
+                        help="run the benchmark suite and write its results to this JSON file")
+    parser.add_argument("--baseline", metavar="BASELINE",
+                        help="compare the suite results with these saved results")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="the fraction by which a measurement may be worse than the baseline")
+    parser.add_argument("--itermax", type=int, default=500)
+    parser.add_argument("--games", type=int, default=5,
+                        help="the number of games that each corpus takes positions from")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.suite is None:
+        bench_move_generation()
+        bench_wide_root()
+        bench_tree_store()
+        bench_undo()
+        bench_determinize()
+        bench_transpositions()
+        bench_node_budget()
+        bench_batched_rollouts()
+        bench_rollout_depth()
+        bench_endgame()
+        bench_parallel_scaling()
+        return 0
+
+    results = run_suite(args.itermax, args.games, args.seed)
+    with open(args.suite, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for name, measurement, old_value, value, ratio in regressions:
+            print "REGRESSION %-20s %-30s %10.4g -> %10.4g (%+.0f%%)" % (
+                name, measurement, old_value, value, 100 * (ratio - 1))
+        if regressions:
+            return 1
+        print "No regressions against %s" % args.baseline
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
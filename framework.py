@@ -15,24 +15,34 @@
 # For more information about Monte Carlo Tree Search check out our web site at www.mcts.ai
 # Also read the article accompanying this code at ***URL HERE***
 
+from array import array
+from copy import deepcopy
+import json
 from math import *
+import multiprocessing
 from operator import attrgetter
 import random
 from blessings import Terminal
 import sys
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
 term = Terminal()
 
 class GameState:
     """ A state of the game, i.e. the game board. These are the only functions which are
         absolutely necessary to implement ismcts in any imperfect information game,
-        although they could be enhanced and made quicker, for example by using a 
-        GetRandomMove() function to generate a random move during rollout.
+        although they could be enhanced and made quicker, for example by overriding
+        get_random_move() to generate a random move during rollout.
         By convention the players are numbered 1, 2, ..., self.number_of_players.
     """
 
     def __init__(self):
         self.number_of_players = 2
         self.player_to_move = 1
+        self._legal_moves = None
 
     def get_next_player(self, p):
         """ Return the player to the left of the specified player
@@ -49,68 +59,243 @@ class GameState:
     def clone_and_randomize(self, observer):
         """ Create a deep clone of this game state, randomizing any information not visible to the specified observer player.
         """
-        return self.clone()
+        st = self.clone()
+        st.randomize(observer)
+        return st
+
+    # Set to True by states whose do_move() returns a token for undo_move(). ismcts
+    # then plays every iteration in one scratch state, randomized in place by
+    # randomize() and returned to the root by undo_move(), rather than cloning.
+    can_undo = False
+
+    def randomize(self, observer):
+        """ Randomize, in place, any information not visible to the specified observer player.
+            By default this deals the cards of get_hidden_cards() with deal_hands().
+        """
+        unseen, sizes = self.get_hidden_cards(observer)
+        if sizes:
+            hands = deal_hands(card_indexes(unseen), [size for (player, size) in sizes], random)
+            self.set_hidden_hands([(player, hand) for ((player, size), hand) in zip(sizes, hands)])
+
+    def get_hidden_cards(self, observer):
+        """ Return (unseen, sizes): the card set of the cards the observer has not
+            seen, and a list of (player, hand size) for the hands they can be in.
+            Some unseen cards may be left over, e.g. those that were never dealt.
+        """
+        return 0, []
+
+    def set_hidden_hands(self, hands):
+        """ Replace the hands of the players in a list of (player, card set) pairs.
+        """
+        raise NotImplementedError("set_hidden_hands")
 
     def do_move(self, move):
         """ update a state by carrying out the given move.
-            Must update player_to_move.
+            Must update player_to_move, and must call invalidate_moves().
+            If can_undo is set, return a token that undo_move() can use to reverse the move.
         """
+        self.invalidate_moves()
+        player = self.player_to_move
         self.player_to_move = self.get_next_player(self.player_to_move)
+        return player
+
+    def undo_move(self, token):
+        """ Reverse the move that do_move() returned token for. Moves must be undone
+            in the reverse of the order they were made in.
+        """
+        self.invalidate_moves()
+        self.player_to_move = token
 
     def get_moves(self):
         """ Get all possible moves from this state.
         """
         pass
 
+    def get_legal_moves(self):
+        """ Get all possible moves from this state, only calling get_moves() once
+            between changes to the state. The returned list must not be modified.
+        """
+        moves = self._legal_moves
+        if moves is None:
+            moves = self._legal_moves = self.get_moves()
+        return moves
+
+    def invalidate_moves(self):
+        """ Forget the moves cached by get_legal_moves(). Must be called whenever
+            the state is changed, other than through do_move().
+        """
+        self._legal_moves = None
+
+    def get_random_move(self, rng):
+        """ Get a random move from this state, using the random number generator rng
+            (e.g. the random module). This chooses uniformly from get_moves(); override
+            it to choose a move without building the list of every move.
+        """
+        return rng.choice(self.get_legal_moves())
+
+    def is_game_over(self):
+        """ Return whether the game has ended. By default this is whether there are
+            no legal moves; override it to tell without generating them.
+        """
+        return not self.get_legal_moves()
+
+    # Whether do_move() keeps the Zobrist keys up to date. do_random_rollout()
+    # turns it off, as nothing looks at the keys of rollout states, and calls
+    # rehash() at the end.
+    hashing = True
+
+    def rehash(self):
+        """ Compute the Zobrist keys from scratch. Must be called whenever the
+            state is changed, other than through do_move(). By default there are none.
+        """
+        pass
+
+    def do_random_rollout(self, rng, undo_log=None, max_moves=None):
+        """ Play moves chosen by get_random_move() until is_game_over(), or until
+            max_moves moves have been played if it is given. Return the number of
+            moves played. If undo_log is a list, the undo token of each move is
+            appended to it. The Zobrist keys are only computed at the end.
+        """
+        num_moves = 0
+        hashing = self.hashing
+        self.hashing = False
+        if undo_log is None:
+            while num_moves != max_moves and not self.is_game_over():
+                self.do_move(self.get_random_move(rng))
+                num_moves += 1
+        else:
+            while num_moves != max_moves and not self.is_game_over():
+                undo_log.append(self.do_move(self.get_random_move(rng)))
+                num_moves += 1
+        if hashing:
+            del self.hashing
+            self.rehash()
+        return num_moves
+
+    def do_random_rollouts(self, states, rng, max_moves=None):
+        """ Play random games from every state in states (states of the same game
+            as this one) to the end, or for at most max_moves moves, and return a
+            list of the number of moves played in each. ismcts calls it in
+            leaf-batched mode. By default this calls do_random_rollout() on each;
+            override it to play the games together.
+        """
+        return [state.do_random_rollout(rng, max_moves=max_moves) for state in states]
+
     def get_result(self, player):
         """ Get the game result from the viewpoint of player. 
         """
         pass
 
+    def evaluate(self, player):
+        """ Return an estimate, from 0 to 1, of the result that get_result(player)
+            will give at the end of the game. ismcts scores the states where a
+            rollout was cut short with it, which may also be the end of the game.
+            By default this is get_result(), which is only right at the end.
+        """
+        return self.get_result(player)
+
+    def solve(self, max_size=None, memo=None):
+        """ Work out the rest of the game exactly, if it is small enough (by the
+            state's own measure, at most max_size, or any size if max_size is None),
+            with perfect play by every player, who can see all of the state. Return
+            {player: result} for the end of the game, or None if it isn't solved.
+            memo is a dictionary that the state may keep solved positions in, which
+            is shared by the calls of a search. By default nothing is solved.
+        """
+        return None
+
+    def zobrist_key(self):
+        """ Return a 64-bit Zobrist key of the whole state, including the hidden
+            cards. Equal states have equal keys.
+        """
+        raise NotImplementedError("zobrist_key")
+
+    def information_set_key(self, observer=None):
+        """ Return a 64-bit Zobrist key of what the observer (by default the
+            player to move) can see. States that the observer can't tell apart
+            have equal keys.
+        """
+        raise NotImplementedError("information_set_key")
+
     def __repr__(self):
         """ Don't need this - but good style.
         """
         pass
 
+def state_fields(state):
+    """ Return a deep copy of the fields of state, other than the moves cached by
+        get_legal_moves(), for checking that two states are the same.
+    """
+    fields = deepcopy(vars(state))
+    fields.pop('_legal_moves', None)
+    return fields
+
+
 class Deck:
     """
     A deck of cards
     """
     def __init__(self):
         self.cards = [Card(rank, suit) for rank in xrange(3, 15 + 1) for suit in
-                ['C', 'D', 'H', 'S']]
+                SUITS]
 
     def shuffle(self):
         random.shuffle(self.cards)
 
 
 NAMES = "???3456789TJQKA2"
+SUITS = ['C', 'D', 'H', 'S']
+SUIT_INDEX = {suit: index for index, suit in enumerate(SUITS)}
 class Card(object):
     """
     A playing card, with rank and suit.
-    rank must be an integer between 3 and 15 inclusive (Jack=11, Queen=12, King=13, Ace=14)
+    rank must be an integer between 2 and 15 inclusive (Jack=11, Queen=12, King=13, Ace=14,
+    Two=15 when twos are high)
     suit must be a string of length 1, one of 'C' (Clubs), 'D' (Diamonds), 'H' (Hearts) or 'S' (Spades)
+
+    Cards are immutable and there is only ever one instance of each card:
+    Card(rank, suit) and Card('9d') return the canonical instance from CARDS, so
+    constructing cards doesn't allocate and cards can be compared by identity and
+    used in sets and as dictionary keys.
     """
-    def __init__(self, rank=None, suit=None):
+    __slots__ = ('rank', 'suit', 'index')
+
+    def __new__(cls, rank=None, suit=None):
         if not suit:
-            suit = rank[1].upper()
-            rank = NAMES.index(rank[0].upper())
-            if rank not in range(2, 15 + 1):
-                raise Exception("Invalid rank")
-            if suit not in ['C', 'D', 'H', 'S']:
-                raise Exception("Invalid suit")
+            card = CARDS_BY_NAME.get(rank[:2].upper())
+            if card is None:
+                raise Exception("Invalid card %s" % rank)
+            return card
 
-        self.rank = rank
-        self.suit = suit
+        card = CARDS.get((rank, suit))
+        if card is None:
+            raise Exception("Invalid card %s%s" % (rank, suit))
+        return card
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Cards are immutable")
+
+    def __reduce__(self):
+        # Unpickle to the canonical instance
+        return Card, (self.rank, self.suit)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __repr__(self):
         return NAMES[self.rank] + PRETTY_SUITS[self.suit]
 
     def __eq__(self, other):
-        return self.rank == other.rank and self.suit == other.suit
+        return self is other
 
     def __ne__(self, other):
-        return self.rank != other.rank or self.suit != other.suit
+        return self is not other
+
+    def __hash__(self):
+        return self.index
 
 
 PRETTY_SUITS = {
@@ -120,6 +305,211 @@ PRETTY_SUITS = {
         "C" : u"\u2663".encode('utf-8') # clubs
     }
 
+
+# Card sets
+#
+# A set of cards is stored as an integer with one bit per card, so that copying,
+# adding, removing and testing for cards are all single integer operations.
+# The card with rank r and suit s is stored in bit (r - 2) * 4 + SUIT_INDEX[s].
+# Ranks 2 to 15 are covered (56 bits), so both a deck where twos are low (rank 2)
+# and one where they are high (rank 15) fit. Each game only uses 52 of the bits.
+# Because the four suits of a rank share a nibble, iterating over the set bits from
+# low to high visits the cards in (rank, suit) order.
+
+def card_index(rank, suit):
+    """ Return the bit index of the card with the given rank and suit.
+    """
+    return (rank - 2) * 4 + SUIT_INDEX[suit]
+
+
+def card_bit(card):
+    """ Return the card set containing just the given card.
+    """
+    return 1 << card.index
+
+
+def card_from_index(index):
+    """ Return the card stored in the given bit index.
+    """
+    return CARDS_BY_INDEX[index]
+
+
+def index_rank(index):
+    """ Return the rank of the card stored in the given bit index.
+    """
+    return index // 4 + 2
+
+
+def card_set(cards):
+    """ Return the card set containing the given cards.
+    """
+    mask = 0
+    for card in cards:
+        mask |= 1 << card.index
+    return mask
+
+
+def card_indexes(mask):
+    """ Return the bit indexes of the cards in the card set, lowest first.
+    """
+    indexes = []
+    while mask:
+        low = mask & -mask
+        indexes.append(low.bit_length() - 1)
+        mask ^= low
+    return indexes
+
+
+def cards_in(mask):
+    """ Return the cards in the card set as a list, sorted by rank then suit.
+    """
+    return [CARDS_BY_INDEX[index] for index in card_indexes(mask)]
+
+
+def popcount(mask):
+    """ Return the number of cards in the card set.
+    """
+    return bin(mask).count('1')
+
+
+def lowest_index(mask):
+    """ Return the bit index of the lowest card in a non-empty card set.
+    """
+    return (mask & -mask).bit_length() - 1
+
+
+def highest_index(mask):
+    """ Return the bit index of the highest card in a non-empty card set.
+    """
+    return mask.bit_length() - 1
+
+
+def deal_hands(indexes, sizes, rng):
+    """ Deal hands of the given sizes from the bit indexes of a pool of cards,
+        with a partial Fisher-Yates shuffle, and return them as a list of card sets.
+        indexes is shuffled in place: any order of the pool deals fairly, so the
+        same list can be dealt from again without being restored.
+    """
+    hands = []
+    remaining = len(indexes)
+    for size in sizes:
+        hand = 0
+        for k in xrange(size):
+            # Move a random undealt card to the end of the undealt part
+            j = int(rng.random() * remaining)
+            remaining -= 1
+            index = indexes[j]
+            indexes[j] = indexes[remaining]
+            indexes[remaining] = index
+            hand |= 1 << index
+        hands.append(hand)
+    return hands
+
+
+def zobrist_keys(count, rng):
+    """ Return a list of count random 64-bit keys for Zobrist hashing, from the
+        random number generator rng (a random.Random with a fixed seed, so that
+        keys are the same in every process).
+    """
+    return [rng.getrandbits(64) for k in xrange(count)]
+
+
+def card_set_key(mask, keys):
+    """ Return the XOR of the Zobrist keys, indexed by bit index, of the cards in the card set.
+    """
+    key = 0
+    while mask:
+        low = mask & -mask
+        key ^= keys[low.bit_length() - 1]
+        mask ^= low
+    return key
+
+
+# All the cards of one rank
+RANK_MASKS = {rank: 0xF << ((rank - 2) * 4) for rank in xrange(2, 15 + 1)}
+
+# All the cards of one suit
+SUIT_MASKS = {suit: sum(1 << card_index(rank, suit) for rank in xrange(2, 15 + 1))
+              for suit in SUITS}
+
+
+def ranks_mask(low, high):
+    """ Return the card set containing every card with a rank from low to high inclusive.
+    """
+    mask = 0
+    for rank in xrange(low, high + 1):
+        mask |= RANK_MASKS[rank]
+    return mask
+
+
+def _intern_card(rank, suit, index):
+    """ Create the canonical instance of a card. Only used to build the card tables.
+    """
+    card = object.__new__(Card)
+    object.__setattr__(card, 'rank', rank)
+    object.__setattr__(card, 'suit', suit)
+    # The bit that represents this card in a card set
+    object.__setattr__(card, 'index', index)
+    return card
+
+
+# The canonical cards, indexed by bit index, by (rank, suit) and by name (e.g. '9D').
+# Any further cards (e.g. jokers) should be added to all three tables with a bit
+# index above the existing ones.
+CARDS_BY_INDEX = [_intern_card(index_rank(index), SUITS[index % 4], index)
+                  for index in xrange(card_index(15, SUITS[-1]) + 1)]
+CARDS = {(card.rank, card.suit): card for card in CARDS_BY_INDEX}
+CARDS_BY_NAME = {NAMES[card.rank] + card.suit: card for card in CARDS_BY_INDEX
+                 if card.rank >= 3}
+
+
+# Moves
+#
+# A move is a machine-sized integer: the card set of the cards played, with a tag
+# for the kind of move in the bits above the cards. Moves are compared, hashed and
+# stored as plain integers, and are only decoded back into cards when they are
+# shown to, or entered by, a human.
+
+MOVE_KIND_SHIFT = 60
+MOVE_CARDS_MASK = (1 << MOVE_KIND_SHIFT) - 1
+
+MOVE_SINGLE = 1  # a single card
+MOVE_COMBO = 2  # several cards of the same rank
+MOVE_STRAIGHT = 3  # a run of cards of the same suit
+MOVE_PASS = 4  # no cards
+
+
+def make_move(kind, cards):
+    """ Return the move of the given kind that plays the card set cards.
+    """
+    return (kind << MOVE_KIND_SHIFT) | cards
+
+
+def move_kind(move):
+    """ Return the kind of the move.
+    """
+    return move >> MOVE_KIND_SHIFT
+
+
+def move_cards(move):
+    """ Return the card set played by the move.
+    """
+    return move & MOVE_CARDS_MASK
+
+
+def move_to_string(move):
+    """ Return a human-readable representation of the move.
+    """
+    if move_kind(move) == MOVE_PASS:
+        return "PASS"
+    return str(cards_in(move_cards(move)))
+
+
+PASS = make_move(MOVE_PASS, 0)
+
+# SINGLE_MOVES[index] is the move that plays the card with that bit index on its own
+SINGLE_MOVES = [make_move(MOVE_SINGLE, 1 << card.index) for card in CARDS_BY_INDEX]
+
 class Node:
     """
     A node in the game tree. Note wins is always from the viewpoint of player_just_moved.
@@ -130,7 +520,8 @@ class Node:
         self.move = move
         # "None" for the root node
         self.parent_node = parent
-        self.child_nodes = []
+        # The child nodes, keyed by move
+        self.child_nodes = {}
         self.wins = 0
         self.visits = 0
         self.avails = 1
@@ -142,11 +533,9 @@ class Node:
         Return the elements of legal_moves for which this node does not have children.
         """
 
-        # Find all moves for which this node *does* have children
-        tried_moves = [child.move for child in self.child_nodes]
-
         # Return all moves that are legal but have not been tried yet
-        return [move for move in legal_moves if move not in tried_moves]
+        children = self.child_nodes
+        return [move for move in legal_moves if move not in children]
 
     def ucb_select_child(self, legal_moves, exploration=0.7):
         """
@@ -154,17 +543,20 @@ class Node:
         exploration is a constant balancing between exploitation and exploration, with default value 0.7 (approximately sqrt(2) / 2)
         """
 
-        # Filter the list of children by the list of legal moves
-        legal_children = [child for child in self.child_nodes if
-                          child.move in legal_moves]
-
-        # Get the child with the highest UCB score
-        s = max(legal_children, key=lambda c: float(c.wins) / float(
-            c.visits) + exploration * sqrt(log(c.avails) / float(c.visits)))
-
-        # update availability counts -- it is easier to do this now than during backpropagation
-        for child in legal_children:
-            child.avails += 1
+        # Filter the children by the list of legal moves, get the child with the
+        # highest UCB score, and update availability counts (it is easier to do
+        # this now than during backpropagation), all in one pass.
+        children = self.child_nodes
+        s = None
+        best_score = -1.0
+        for move in legal_moves:
+            c = children.get(move)
+            if c is not None:
+                score = c.wins / float(c.visits) + exploration * sqrt(log(c.avails) / float(c.visits))
+                c.avails += 1
+                if score > best_score:
+                    s = c
+                    best_score = score
 
         # Return the child selected above
         return s
@@ -175,27 +567,30 @@ class Node:
         Return the added child node
         """
         n = Node(move=m, parent=self, player_just_moved=p)
-        self.child_nodes.append(n)
+        self.child_nodes[m] = n
         return n
 
-    def update(self, terminal_state):
+    def update(self, terminal_state, virtual_loss=False):
         """
         update this node - increment the visit count by one, and increase the win count by the result of terminal_state for self.player_just_moved.
+        If virtual_loss is set, the visit was already counted when the node was selected.
         """
-        self.visits += 1
+        if not virtual_loss:
+            self.visits += 1
         if self.player_just_moved is not None:
             self.wins += terminal_state.get_result(self.player_just_moved)
 
     def __repr__(self):
         return "[M:%s W/V/A: %4i/%4i/%4i]" % (
-        self.move, self.wins, self.visits, self.avails)
+        self.move if self.move is None else move_to_string(self.move),
+        self.wins, self.visits, self.avails)
 
     def tree_to_string(self, indent):
         """
         Represent the tree as a string, for debugging purposes.
         """
         s = self.indent_string(indent) + str(self)
-        for c in sorted(self.child_nodes, key=attrgetter('visits', 'wins')):
+        for c in sorted(self.child_nodes.itervalues(), key=attrgetter('visits', 'wins')):
             s += c.tree_to_string(indent + 1)
         return s
 
@@ -208,68 +603,1213 @@ class Node:
 
     def children_to_string(self):
         s = ""
-        for c in sorted(self.child_nodes, key=attrgetter('visits', 'wins')):
+        for c in sorted(self.child_nodes.itervalues(), key=attrgetter('visits', 'wins')):
             s += str(c) + "\n"
         return s
 
+    def count_nodes(self):
+        """ Return the number of nodes in the tree below and including this one.
+        """
+        count = 0
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            count += 1
+            nodes.extend(node.child_nodes.itervalues())
+        return count
+
+
+class NodeTree:
+    """
+    A search tree made of Node objects. The search handles nodes through the tree,
+    so that it can grow either this or an ArrayTree.
+    """
+    # Whether add_child takes the key of the observer's information set after
+    # the move (see TranspositionTree)
+    transpositions = False
+
+    def __init__(self, root=None):
+        if root is None:
+            self.root = Node()
+            self.node_count = 1
+        else:
+            self.root = root
+            self.node_count = root.count_nodes()
+        self.peak_node_count = self.node_count
+
+    def get_untried_moves(self, node, legal_moves):
+        return node.get_untried_moves(legal_moves)
+
+    def select_child(self, node, legal_moves, exploration):
+        return node.ucb_select_child(legal_moves, exploration)
+
+    def get_move(self, node):
+        return node.move
+
+    def add_child(self, node, m, p):
+        self.node_count += 1
+        if self.node_count > self.peak_node_count:
+            self.peak_node_count = self.node_count
+        return node.add_child(m, p)
+
+    def bytes_per_node(self):
+        """ Return roughly how much memory a node takes, in bytes.
+        """
+        node = Node()
+        return sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node.child_nodes)
+
+    def prune(self, target):
+        """ Remove the subtrees of the least visited nodes, other than the children
+            of the root, until at most target nodes remain or there is nothing
+            left to remove. Return the number of nodes removed.
+        """
+        candidates = []
+        stack = [grandchild for child in self.root.child_nodes.itervalues()
+                 for grandchild in child.child_nodes.itervalues()]
+        while stack:
+            node = stack.pop()
+            candidates.append(node)
+            stack.extend(node.child_nodes.itervalues())
+        candidates.sort(key=attrgetter('visits'))
+
+        removed = 0
+        for node in candidates:
+            if self.node_count - removed <= target:
+                break
+            if node.parent_node is None:
+                # Already removed along with an ancestor
+                continue
+            del node.parent_node.child_nodes[node.move]
+            stack = [node]
+            while stack:
+                old = stack.pop()
+                old.parent_node = None
+                stack.extend(old.child_nodes.itervalues())
+                removed += 1
+        self.node_count -= removed
+        return removed
+
+    def add_virtual_loss(self, node):
+        """ Count a visit, with no win, to node and its ancestors, until the
+            result of its rollout is backpropagated with virtual_loss set.
+        """
+        while node:
+            node.visits += 1
+            node = node.parent_node
+
+    def backpropagate(self, node, terminal_state, virtual_loss=False):
+        while node:  # backpropagate from the expanded node and work back to the root node
+            node.update(terminal_state, virtual_loss)
+            node = node.parent_node
+
+    def best_move(self, legal_moves=None):
+        """ Return the move of the most visited child of the root, only considering
+            the children for legal_moves if given.
+        """
+        children = self.root.child_nodes
+        if legal_moves is not None:
+            children = {move: children[move] for move in legal_moves if move in children}
+        return max(children.itervalues(), key=lambda c: c.visits).move
+
+    def subtree(self, move):
+        """ Return a NodeTree rooted at the child of the root for move, or an empty
+            tree if there is no such child. The rest of this tree is dropped.
+        """
+        child = self.root.child_nodes.get(move)
+        if child is None:
+            return NodeTree()
+        child.parent_node = None
+        return NodeTree(child)
+
+    def root_statistics(self):
+        """ Return {move: (wins, visits)} for the children of the root.
+        """
+        return {move: (c.wins, c.visits) for move, c in self.root.child_nodes.iteritems()}
+
+    def tree_to_string(self):
+        return self.root.tree_to_string(0)
 
-def ismcts(rootstate, itermax, verbose=False, quiet=False):
+    def children_to_string(self):
+        return self.root.children_to_string()
+
+
+class ArrayTree:
     """
-    Conduct an ismcts search for itermax iterations starting from rootstate.
-    Return the best move from the rootstate.
+    A search tree stored as parallel arrays with one entry per node, rather than
+    as one Node object per node. A node is an index into the arrays, and node 0
+    is the root. The children of a node form a linked list through first_child
+    and next_sibling, with NO_NODE marking the end of the list. This makes a node
+    cost a few dozen bytes rather than several hundred, and growing the tree
+    appends to the arrays instead of allocating objects.
+    Pruning puts the entries of the removed nodes on a free list, and new nodes
+    reuse them before the arrays grow.
     """
+    NO_NODE = -1
+    # The parent of a node that is on the free list
+    FREE_NODE = -2
+    transpositions = False
+
+    # Select among at least this many children with NumPy, if it is installed.
+    # Below this the fixed cost of calling into NumPy outweighs the gain.
+    numpy_min_children = 128
+
+    def __init__(self):
+        self.wins = array('d')
+        self.visits = array('l')
+        self.avails = array('l')
+        self.moves = array('l')
+        # The player who made the move into the node, or NO_NODE for the root
+        self.players = array('l')
+        self.parents = array('l')
+        self.first_child = array('l')
+        self.next_sibling = array('l')
+        self.free = []
+        self.root = self._new_node(0, self.NO_NODE, self.NO_NODE)
+
+    def _new_node(self, m, parent, p):
+        if self.free:
+            node = self.free.pop()
+            self.wins[node] = 0.0
+            self.visits[node] = 0
+            self.avails[node] = 1
+            self.moves[node] = m
+            self.players[node] = p
+            self.parents[node] = parent
+            self.first_child[node] = self.NO_NODE
+            self.next_sibling[node] = self.NO_NODE
+            return node
+        self.wins.append(0.0)
+        self.visits.append(0)
+        self.avails.append(1)
+        self.moves.append(m)
+        self.players.append(p)
+        self.parents.append(parent)
+        self.first_child.append(self.NO_NODE)
+        self.next_sibling.append(self.NO_NODE)
+        return len(self.visits) - 1
+
+    @property
+    def node_count(self):
+        return len(self.visits) - len(self.free)
+
+    @property
+    def peak_node_count(self):
+        # The arrays only grow, so their length is the most nodes there have been
+        return len(self.visits)
+
+    def bytes_per_node(self):
+        """ Return how much memory a node takes, in bytes.
+        """
+        return sum(a.itemsize for a in (self.wins, self.visits, self.avails, self.moves,
+                                        self.players, self.parents, self.first_child,
+                                        self.next_sibling))
+
+    def prune(self, target):
+        """ Remove the subtrees of the least visited nodes, other than the children
+            of the root, until at most target nodes remain or there is nothing
+            left to remove, and put them on the free list. Return the number of
+            nodes removed.
+        """
+        candidates = []
+        stack = [grandchild for child in self.children(self.root)
+                 for grandchild in self.children(child)]
+        while stack:
+            node = stack.pop()
+            candidates.append(node)
+            stack.extend(self.children(node))
+        visits = self.visits
+        candidates.sort(key=visits.__getitem__)
+
+        parents, first_child, next_sibling = self.parents, self.first_child, self.next_sibling
+        removed = 0
+        for node in candidates:
+            if self.node_count <= target:
+                break
+            parent = parents[node]
+            if parent == self.FREE_NODE:
+                # Already removed along with an ancestor
+                continue
+            # Unlink the node from its siblings
+            if first_child[parent] == node:
+                first_child[parent] = next_sibling[node]
+            else:
+                sibling = first_child[parent]
+                while next_sibling[sibling] != node:
+                    sibling = next_sibling[sibling]
+                next_sibling[sibling] = next_sibling[node]
+            stack = [node]
+            while stack:
+                old = stack.pop()
+                stack.extend(self.children(old))
+                parents[old] = self.FREE_NODE
+                first_child[old] = self.NO_NODE
+                self.free.append(old)
+                removed += 1
+        return removed
+
+    def children(self, node):
+        """ Return the children of node.
+        """
+        children = []
+        child = self.first_child[node]
+        while child != self.NO_NODE:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    def get_untried_moves(self, node, legal_moves):
+        """ Return the elements of legal_moves for which node does not have children.
+        """
+        moves = self.moves
+        tried_moves = set(moves[child] for child in self.children(node))
+        return [move for move in legal_moves if move not in tried_moves]
+
+    def select_child(self, node, legal_moves, exploration):
+        """ Use the UCB1 formula to select a child of node, filtered by the given list of legal moves,
+            and update the availability counts of the legal children.
+            Wide nodes are scored with NumPy, operating on the stat arrays of all the
+            children at once; other nodes in a single pass over the children.
+        """
+        if numpy is not None and len(legal_moves) >= self.numpy_min_children:
+            return self._select_child_numpy(node, legal_moves, exploration)
+
+        legal_moves = set(legal_moves)
+        moves, wins, visits, avails = self.moves, self.wins, self.visits, self.avails
+        next_sibling = self.next_sibling
+        s = self.NO_NODE
+        best_score = -1.0
+        child = self.first_child[node]
+        while child != self.NO_NODE:
+            if moves[child] in legal_moves:
+                v = visits[child]
+                score = wins[child] / v + exploration * sqrt(log(avails[child]) / v)
+                avails[child] += 1
+                if score > best_score:
+                    s = child
+                    best_score = score
+            child = next_sibling[child]
+        return s
+
+    def _select_child_numpy(self, node, legal_moves, exploration):
+        """ select_child for wide nodes, using NumPy views of the stat arrays.
+        """
+        children = numpy.array(self.children(node))
+        # The views share memory with the arrays, so must not outlive this call -
+        # adding a node may move the arrays.
+        moves = numpy.frombuffer(self.moves, dtype='l')
+        children = children[numpy.in1d(moves[children], numpy.array(legal_moves, dtype='l'))]
+
+        visits = numpy.frombuffer(self.visits, dtype='l')[children]
+        avails = numpy.frombuffer(self.avails, dtype='l')
+        scores = numpy.frombuffer(self.wins, dtype='d')[children] / visits + \
+            exploration * numpy.sqrt(numpy.log(avails[children]) / visits)
+        avails[children] += 1
+        return int(children[scores.argmax()])
+
+    def get_move(self, node):
+        return self.moves[node]
+
+    def add_child(self, node, m, p):
+        """ Add a new child of node for the move m, made by player p. Return the added child.
+        """
+        child = self._new_node(m, node, p)
+        self.next_sibling[child] = self.first_child[node]
+        self.first_child[node] = child
+        return child
+
+    def add_virtual_loss(self, node):
+        """ Count a visit, with no win, to node and its ancestors, until the
+            result of its rollout is backpropagated with virtual_loss set.
+        """
+        visits, parents = self.visits, self.parents
+        while node != self.NO_NODE:
+            visits[node] += 1
+            node = parents[node]
+
+    def backpropagate(self, node, terminal_state, virtual_loss=False):
+        """ Update node and its ancestors with the result of terminal_state. If
+            virtual_loss is set, add_virtual_loss has already counted the visits.
+        """
+        wins, visits, players, parents = self.wins, self.visits, self.players, self.parents
+        visit = 0 if virtual_loss else 1
+        while node != self.NO_NODE:
+            visits[node] += visit
+            if players[node] != self.NO_NODE:
+                wins[node] += terminal_state.get_result(players[node])
+            node = parents[node]
 
-    rootnode = Node()
-    if len(rootstate.get_moves()) > 1:
+    def best_move(self, legal_moves=None):
+        """ Return the move of the most visited child of the root, only considering
+            the children for legal_moves if given.
+        """
+        children = self.children(self.root)
+        if legal_moves is not None:
+            legal_moves = set(legal_moves)
+            children = [c for c in children if self.moves[c] in legal_moves]
+        return self.moves[max(children, key=lambda c: self.visits[c])]
+
+    def subtree(self, move):
+        """ Return an ArrayTree holding the subtree of the child of the root for move,
+            or an empty tree if there is no such child. The nodes are copied, so
+            the rest of this tree is dropped along with it.
+        """
+        tree = ArrayTree()
+        for old_root in self.children(self.root):
+            if self.moves[old_root] == move:
+                break
+        else:
+            return tree
+
+        tree.moves[tree.root] = move
+        tree.players[tree.root] = self.players[old_root]
+        stack = [(old_root, tree.root)]
+        while stack:
+            old, new = stack.pop()
+            tree.wins[new] = self.wins[old]
+            tree.visits[new] = self.visits[old]
+            tree.avails[new] = self.avails[old]
+            for old_child in self.children(old):
+                stack.append((old_child, tree.add_child(new, self.moves[old_child],
+                                                        self.players[old_child])))
+        return tree
+
+    def root_statistics(self):
+        """ Return {move: (wins, visits)} for the children of the root.
+        """
+        return {self.moves[c]: (self.wins[c], self.visits[c]) for c in self.children(self.root)}
+
+    def node_to_string(self, node):
+        return "[M:%s W/V/A: %4i/%4i/%4i]" % (
+            None if node == self.root else move_to_string(self.moves[node]),
+            self.wins[node], self.visits[node], self.avails[node])
+
+    def _sorted_children(self, node):
+        return sorted(self.children(node), key=lambda c: (self.visits[c], self.wins[c]))
+
+    def tree_to_string(self, node=0, indent=0):
+        """ Represent the tree as a string, for debugging purposes.
+        """
+        s = Node.indent_string(indent) + self.node_to_string(node)
+        for c in self._sorted_children(node):
+            s += self.tree_to_string(c, indent + 1)
+        return s
+
+    def children_to_string(self):
+        s = ""
+        for c in self._sorted_children(self.root):
+            s += self.node_to_string(c) + "\n"
+        return s
+
+
+class TranspositionTree:
+    """
+    A search graph of Node objects in which every path that reaches the same
+    information set of the observer shares one node, and so its statistics.
+    Nodes are found by the information_set_key of the state they stand for,
+    through a table of 2 * capacity entries. The table is split into buckets of
+    two: the first entry of a bucket keeps whichever node has the most visits
+    and the second keeps the newest, so a busy node is not pushed out by the
+    stream of new ones. Nodes that drop out of the table stay in the graph, but
+    are no longer shared.
+    Every node has a depth, and a node can only join the graph below a parent
+    of lower depth, which keeps the graph free of cycles (e.g. both players
+    passing in turn with nothing on the table). Backpropagation follows the
+    path the iteration actually took rather than the parents of the nodes.
+    """
+    transpositions = True
+
+    def __init__(self, capacity=1 << 16, root=None):
+        self.capacity = capacity
+        self.table = [None] * (2 * capacity)
+        if root is None:
+            root = Node()
+            root.key = None
+            root.depth = 0
+        self.root = root
+        self.node_count = self._count_nodes()
+        self.peak_node_count = self.node_count
+        self.path = [(root, None)]
+        # Counters of the table
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def _count_nodes(self):
+        return len(self.reachable_nodes())
+
+    def reachable_nodes(self):
+        """ Return {id(node): node} for every node that can be reached from the root.
+        """
+        seen = {}
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if id(node) not in seen:
+                seen[id(node)] = node
+                nodes.extend(node.child_nodes.itervalues())
+        return seen
+
+    def hit_rate(self):
+        """ Return the fraction of lookups that found a node to share.
+        """
+        return self.hits / float(self.lookups) if self.lookups else 0.0
+
+    def _lookup(self, key, player):
+        """ Return the node in the table for key and player, or None.
+        """
+        self.lookups += 1
+        slot = 2 * (key % self.capacity)
+        table = self.table
+        for i in (slot, slot + 1):
+            node = table[i]
+            if node is not None and node.key == key and node.player_just_moved == player:
+                if i == slot + 1 and (table[slot] is None or node.visits > table[slot].visits):
+                    # Promote the newest node once it is the busier one
+                    table[slot], table[slot + 1] = node, table[slot]
+                return node
+        return None
+
+    def _store(self, node):
+        """ Put a new node in the second entry of its bucket.
+        """
+        self.stores += 1
+        slot = 2 * (node.key % self.capacity)
+        table = self.table
+        if table[slot] is None:
+            table[slot] = node
+        else:
+            if table[slot + 1] is not None:
+                self.replacements += 1
+            table[slot + 1] = node
+
+    def get_untried_moves(self, node, legal_moves):
+        return node.get_untried_moves(legal_moves)
+
+    def select_child(self, node, legal_moves, exploration):
+        if node is self.root:
+            # A new iteration
+            del self.path[1:]
+        children = node.child_nodes
+        s = None
+        s_move = None
+        best_score = -1.0
+        for move in legal_moves:
+            c = children.get(move)
+            if c is not None:
+                score = c.wins / float(c.visits) + exploration * sqrt(log(c.avails) / float(c.visits))
+                c.avails += 1
+                if score > best_score:
+                    s = c
+                    s_move = move
+                    best_score = score
+        self.path.append((s, s_move))
+        return s
+
+    def get_move(self, node):
+        # A shared node may be reached by different moves, so use the move that
+        # the path took to it
+        return self.path[-1][1]
+
+    def add_child(self, node, m, p, key=None):
+        """ Add a child of node for the move m by player p, sharing the node for
+            key (the observer's information set after the move) if there is one.
+            If key is None, the child is not shared.
+        """
+        if node is self.root:
+            # A new iteration
+            del self.path[1:]
+        depth = node.depth + 1
+        child = None if key is None else self._lookup(key, p)
+        if child is not None and child.depth >= depth:
+            self.hits += 1
+        else:
+            child = Node(move=m, parent=node, player_just_moved=p)
+            child.key = key
+            child.depth = depth
+            self.node_count += 1
+            self.peak_node_count = self.node_count
+            if key is not None:
+                self._store(child)
+        node.child_nodes[m] = child
+        self.path.append((child, m))
+        return child
+
+    def backpropagate(self, node, terminal_state):
+        for (path_node, move) in self.path:
+            path_node.update(terminal_state)
+
+    def best_move(self, legal_moves=None):
+        """ Return the move of the most visited child of the root, only considering
+            the children for legal_moves if given.
+        """
+        children = self.root.child_nodes
+        if legal_moves is not None:
+            children = {move: children[move] for move in legal_moves if move in children}
+        return max(children.iteritems(), key=lambda (move, c): c.visits)[0]
+
+    def subtree(self, move):
+        """ Return a TranspositionTree rooted at the child of the root for move,
+            or an empty tree if there is no such child. The nodes below the child
+            keep their statistics, with their depths rebased so that the child
+            is at depth 0, and the table is rebuilt from them alone so that the
+            rest of the graph can be freed.
+        """
+        child = self.root.child_nodes.get(move)
+        if child is None:
+            return TranspositionTree(self.capacity)
+        tree = TranspositionTree(self.capacity, child)
+        nodes = tree.reachable_nodes()
+        base = child.depth
+        for node in nodes.itervalues():
+            node.depth -= base
+            if id(node.parent_node) not in nodes:
+                node.parent_node = None
+        child.parent_node = None
+        # Fill the table as _lookup leaves it: the busier node of a bucket first
+        table = tree.table
+        for node in sorted(nodes.itervalues(), key=attrgetter('visits'), reverse=True):
+            if node.key is not None:
+                slot = 2 * (node.key % tree.capacity)
+                if table[slot] is None:
+                    table[slot] = node
+                elif table[slot + 1] is None:
+                    table[slot + 1] = node
+        return tree
+
+    def root_statistics(self):
+        """ Return {move: (wins, visits)} for the children of the root.
+        """
+        return {move: (c.wins, c.visits) for move, c in self.root.child_nodes.iteritems()}
+
+    def tree_to_string(self):
+        return self.root.tree_to_string(0)
+
+    def children_to_string(self):
+        return self.root.children_to_string()
+
+    def __repr__(self):
+        return "[Nodes: %i Lookups: %i Hit rate: %.3f Stores: %i Replacements: %i]" % (
+            self.node_count, self.lookups, self.hit_rate(), self.stores, self.replacements)
+
+
+class Determinizer:
+    """
+    Deals determinizations of a root state for an observer. The unseen cards and
+    the hidden hand sizes are the same in every state of a search, so they are
+    found once, when the Determinizer is made, and each deal only shuffles.
+    If count is given, count deals are made up front and then used in turn.
+    States without hidden hands are randomized with their own randomize().
+    """
+
+    def __init__(self, rootstate, observer, count=None, rng=random):
+        self.observer = observer
+        self.rng = rng
+        unseen, sizes = rootstate.get_hidden_cards(observer)
+        self.players = [player for (player, size) in sizes]
+        self.sizes = [size for (player, size) in sizes]
+        self.indexes = card_indexes(unseen)
+        self.batch = None
+        self.next_deal = 0
+        if count is not None and self.players:
+            self.batch = [self.deal_hands() for k in xrange(count)]
+
+    def deal_hands(self):
+        """ Return a new deal, as a list of (player, card set) pairs.
+        """
+        return zip(self.players, deal_hands(self.indexes, self.sizes, self.rng))
+
+    def randomize(self, state):
+        """ Randomize, in place, a state with the same information set as the root state.
+        """
+        if not self.players:
+            state.randomize(self.observer)
+        elif self.batch is None:
+            state.set_hidden_hands(self.deal_hands())
+        else:
+            state.set_hidden_hands(self.batch[self.next_deal])
+            self.next_deal = (self.next_deal + 1) % len(self.batch)
+
+
+class SearchProgress:
+    """
+    Receives progress reports from a running ismcts search. This one ignores
+    them; subclass it to show them. update() returns the iteration count at which
+    it next wants to be called, or None for never, so the search only pays for a
+    report when one is due.
+    """
+
+    def start(self, itermax, time_budget):
+        """ Called before the first iteration, with the limits of the search.
+        Return the iteration count of the first update, or None.
+        """
+        return None
+
+    def update(self, iterations, tree):
+        """ Called once iterations iterations have been completed. Return the
+        iteration count of the next update, or None.
+        """
+        return None
+
+
+class TerminalProgress(SearchProgress):
+    """
+    Shows the iteration count and the best move so far on the bottom line of
+    the terminal, every interval seconds and/or every iteration_interval
+    iterations (by default, every 0.1 seconds). The time interval is turned into
+    an iteration count from the rate of the search so far. When the output is
+    not a terminal (e.g. it is piped or logged), nothing is shown.
+    """
+
+    def __init__(self, interval=None, iteration_interval=None):
+        if interval is None and iteration_interval is None:
+            interval = 0.1
+        self.interval = interval
+        self.iteration_interval = iteration_interval
+        self.limit = None
+        self.start_time = None
+
+    def start(self, itermax, time_budget):
+        self.limit = itermax if itermax is not None else "%.1fs" % time_budget
+        self.start_time = time.time()
+        return 1
+
+    def update(self, iterations, tree):
+        if term.height is not None:
+            with term.location(0, term.height - 1):
+                print("Iteration %s/%s - Best so far (%s)" % (
+                    iterations, self.limit, move_to_string(tree.best_move()))),
+                sys.stdout.flush()
+
+        step = self.iteration_interval
+        if self.interval is not None:
+            elapsed = time.time() - self.start_time
+            if elapsed > 0:
+                timed_step = max(1, int(iterations * self.interval / elapsed))
+            else:
+                timed_step = iterations
+            step = timed_step if step is None else min(step, timed_step)
+        return iterations + step
+
+
+class SearchStats:
+    """
+    A profile of an ismcts search: the time spent in each phase of the
+    iterations, the number of calls made to the game state, the length of the
+    rollouts and the size of the tree.
+    """
+
+    PHASES = ('determinize', 'select', 'expand', 'simulate', 'backpropagate', 'undo')
+    COUNTED_CALLS = ('get_moves', 'do_move', 'undo_move', 'clone')
+
+    def __init__(self):
+        self.phase_times = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.COUNTED_CALLS, 0)
+        self.iterations = 0
+        self.rollout_moves = 0
+        self.max_depth = 0
+        self.node_count = 0
+        self.solved = 0
+        self._phase = None
+        self._phase_start = 0.0
+
+    def begin_phase(self, phase):
+        """ Charge the time since the last call to the phase it began, and begin phase.
+        """
+        now = time.time()
+        if self._phase is not None:
+            self.phase_times[self._phase] += now - self._phase_start
+        self._phase = phase
+        self._phase_start = now
+
+    def end_phase(self):
+        """ Charge the time since the last call to begin_phase to its phase.
+        """
+        if self._phase is not None:
+            self.phase_times[self._phase] += time.time() - self._phase_start
+            self._phase = None
+
+    def count_calls(self, state):
+        """ Count the calls made to the get_moves, do_move and undo_move methods
+        of state (including its own calls), by shadowing them on the instance.
+        """
+        calls = self.calls
+
+        def counted(name, method):
+            def call(*args):
+                calls[name] += 1
+                return method(*args)
+            return call
+
+        for name in ('get_moves', 'do_move', 'undo_move'):
+            setattr(state, name, counted(name, getattr(state, name)))
+
+    def average_rollout_length(self):
+        return self.rollout_moves / float(self.iterations) if self.iterations else 0.0
+
+    def to_dict(self):
+        """ Return the statistics as a dictionary of plain values.
+        """
+        return {
+            'phase_times': dict(self.phase_times),
+            'calls': dict(self.calls),
+            'iterations': self.iterations,
+            'rollout_moves': self.rollout_moves,
+            'average_rollout_length': self.average_rollout_length(),
+            'max_depth': self.max_depth,
+            'node_count': self.node_count,
+            'solved': self.solved,
+        }
+
+    def to_json(self, **kwargs):
+        """ Return the statistics as a JSON string. kwargs are passed to json.dumps.
+        """
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def __repr__(self):
+        total = sum(self.phase_times.itervalues()) or 1.0
+        return "[%s Rollout length: %.1f Max depth: %i Nodes: %i]" % (
+            " ".join("%s: %.0f%%" % (phase, 100 * self.phase_times[phase] / total)
+                     for phase in self.PHASES),
+            self.average_rollout_length(), self.max_depth, self.node_count)
+
+
+class SearchResult:
+    """
+    The outcome of an ismcts search: the best move, the number of iterations
+    completed, the wall-clock time taken in seconds and the tree that was grown
+    (with its current and peak node counts), and the SearchStats of the search
+    if it was profiled.
+    """
+
+    def __init__(self, move, iterations, elapsed, tree, stats=None):
+        self.move = move
+        self.iterations = iterations
+        self.elapsed = elapsed
+        self.iterations_per_second = iterations / elapsed if elapsed > 0 else 0.0
+        self.tree = tree
+        self.tree_size = tree.node_count
+        self.peak_tree_size = tree.peak_node_count
+        self.stats = stats
+
+    def __repr__(self):
+        return "[Move: %s Iterations: %i (%.0f/sec) Tree size: %i]" % (
+            move_to_string(self.move), self.iterations, self.iterations_per_second,
+            self.tree_size)
+
+
+class EvaluatedState:
+    """
+    Stands in for the state at the end of a rollout that was cut short, so that
+    the tree backpropagates the state's evaluate() in place of get_result().
+    """
+
+    def __init__(self, state):
+        self.get_result = state.evaluate
+
+
+class SolvedState:
+    """
+    Stands in for the end of a game that was worked out by solve(), so that the
+    tree backpropagates the {player: result} that solve() returned.
+    """
+
+    def __init__(self, results):
+        self.get_result = results.__getitem__
+
+
+# The fraction of the node budget that ismcts prunes the tree down to
+PRUNE_TO = 0.75
+
+
+def _descend(state, tree, exploration, expand, observer, undo_log=None, stats=None):
+    """ Select from the root of tree down to a node that isn't fully expanded,
+        playing the moves in state, and expand it with a random untried move if
+        expand is set (or it is the root). Return the node reached and its depth.
+    """
+    node = tree.root
+    depth = 0
+
+    # Select - the legal moves are fetched once per step
+    if stats is not None:
+        stats.begin_phase('select')
+    moves = state.get_legal_moves()
+    untried_moves = tree.get_untried_moves(node, moves)
+    while moves and not untried_moves:  # node is fully expanded and non-terminal
+        node = tree.select_child(node, moves, exploration)
+        token = state.do_move(tree.get_move(node))
+        if undo_log is not None:
+            undo_log.append(token)
+        moves = state.get_legal_moves()
+        untried_moves = tree.get_untried_moves(node, moves)
+        depth += 1
+
+    # Expand
+    if stats is not None:
+        stats.begin_phase('expand')
+    # if we can expand (i.e. state/node is non-terminal, and the root or within the budget)
+    if untried_moves and (expand or node == tree.root):
+        m = random.choice(untried_moves)
+        player = state.player_to_move
+        token = state.do_move(m)
+        if undo_log is not None:
+            undo_log.append(token)
+        # add child and descend tree
+        if tree.transpositions:
+            node = tree.add_child(node, m, player, state.information_set_key(observer))
+        else:
+            node = tree.add_child(node, m, player)
+        depth += 1
+    return node, depth
+
+
+def ismcts(rootstate, itermax=None, verbose=False, quiet=False, exploration=0.7,
+           tree=None, time_budget=None, determinizations=None, progress=None,
+           profile=False, max_nodes=None, max_bytes=None, batch_size=None,
+           rollout_depth=None, endgame_size=None):
+    """
+    Conduct an ismcts search starting from rootstate, and return the best move.
+    See ismcts_search for the arguments.
+    """
+    return ismcts_search(rootstate, itermax, verbose, quiet, exploration, tree,
+                         time_budget, determinizations, progress, profile, max_nodes,
+                         max_bytes, batch_size, rollout_depth, endgame_size).move
+
+
+def ismcts_search(rootstate, itermax=None, verbose=False, quiet=False,
+                  exploration=0.7, tree=None, time_budget=None,
+                  determinizations=None, progress=None, profile=False,
+                  max_nodes=None, max_bytes=None, batch_size=None, rollout_depth=None,
+                  endgame_size=None):
+    """
+    Conduct an ismcts search starting from rootstate, for itermax iterations or
+    until time_budget seconds have passed, whichever comes first. At least one of
+    them must be given. The search always completes at least one iteration (or
+    batch), so that there is a move to return however short the time_budget.
+    Return a SearchResult holding the best move from the rootstate.
+    tree is the tree to grow: a new NodeTree unless another is given (e.g. an
+    ArrayTree, or the tree kept by a SearchSession from earlier searches).
+    If rootstate.can_undo is set, every iteration is played in one scratch copy
+    of rootstate, which is randomized in place and then undone back to the root.
+    determinizations is the number of deals of the hidden cards to make before
+    searching and then cycle through; by default every iteration deals afresh.
+    progress is the SearchProgress to report to while searching: by default a
+    TerminalProgress, or nothing if quiet is set.
+    If profile is set, the SearchResult also holds the SearchStats of the search.
+    max_nodes and max_bytes bound the size of the tree. When it reaches the budget,
+    the tree prunes the subtrees of its least visited nodes down to PRUNE_TO of
+    the budget. If only the children of the root are left, the search carries on
+    adding nothing but children of the root.
+    If batch_size is given, the search is leaf-batched: each step descends to
+    batch_size leaves, in separate clones of rootstate, adding a virtual loss to
+    each path so that the leaves differ, and then plays out all of their rollouts
+    with one call of rootstate.do_random_rollouts(). The tree is only pruned
+    between batches, so a batch can take it up to batch_size nodes past max_nodes.
+    If rollout_depth is given, rollouts stop after that many moves, and the state
+    they reach is scored with evaluate() rather than get_result().
+    If endgame_size is given, the leaves whose states can be solved with
+    solve(endgame_size) are scored with the results of perfect play in place of
+    a rollout. The solved positions are remembered for the rest of the search.
+    """
+    if itermax is None and time_budget is None:
+        raise Exception("ismcts needs an iteration count, a time budget or both")
+    if tree is None:
+        tree = NodeTree()
+    root = tree.root
+    if (max_nodes is not None or max_bytes is not None) and not hasattr(tree, 'prune'):
+        raise Exception("%s can't be pruned to a node budget" % tree.__class__.__name__)
+    if max_bytes is not None:
+        byte_nodes = max_bytes // tree.bytes_per_node()
+        max_nodes = byte_nodes if max_nodes is None else min(max_nodes, byte_nodes)
+    if batch_size is not None and not hasattr(tree, 'add_virtual_loss'):
+        raise Exception("%s can't batch leaves" % tree.__class__.__name__)
+    expand = True
+    if progress is None:
+        progress = SearchProgress() if quiet else TerminalProgress()
+    stats = SearchStats() if profile else None
+
+    start = time.time()
+    deadline = None if time_budget is None else start + time_budget
+    i = 0
+    endgame_memo = {}
+
+    root_moves = rootstate.get_legal_moves()
+    if len(root_moves) > 1:
         # There are moves. Simulate them
+        observer = rootstate.player_to_move
+        determinizer = Determinizer(rootstate, observer, determinizations)
+        next_report = progress.start(itermax, time_budget)
+        if batch_size is not None:
+            # Leaf-batched: descend to batch_size leaves, each in its own determinization,
+            # then play out all of their rollouts with one do_random_rollouts() call
+            while (itermax is None or i < itermax) and (i == 0 or deadline is None or time.time() < deadline):
+                if max_nodes is not None and expand and tree.node_count >= max_nodes:
+                    expand = tree.prune(int(max_nodes * PRUNE_TO)) > 0
+                count = batch_size if itermax is None else min(batch_size, itermax - i)
 
-        for i in range(itermax):
-            node = rootnode
-
-            # Determinize
-            state = rootstate.clone_and_randomize(rootstate.player_to_move)
-
-            # Select
-            while state.get_moves() != [] and node.get_untried_moves(
-                    state.get_moves()) == []:  # node is fully expanded and non-terminal
-                node = node.ucb_select_child(state.get_moves())
-                state.do_move(node.move)
-
-            # Expand
-            untried_moves = node.get_untried_moves(state.get_moves())
-            if untried_moves:  # if we can expand (i.e. state/node is non-terminal)
-                m = random.choice(untried_moves)
-                player = state.player_to_move
-                state.do_move(m)
-                node = node.add_child(m, player)  # add child and descend tree
-
-            # Simulate
-            while state.get_moves():  # while state is non-terminal
-                state.do_move(random.choice(state.get_moves()))
-
-            # Backpropagate
-            while node:  # backpropagate from the expanded node and work back to the root node
-                node.update(state)
-                node = node.parent_node
-
-            if not quiet:
-                with term.location(0, term.height - 1):
-                    print("Iteration %s/%s - Best so far (%s)" % (i, itermax, max(rootnode.child_nodes, key=lambda
-            c: c.visits).move)),
-                    sys.stdout.flush()
-    else:
-        rootnode.add_child(rootstate.get_moves()[0], rootstate.player_to_move)
+                leaves = []
+                for b in xrange(count):
+                    # Determinize
+                    if stats is not None:
+                        stats.begin_phase('determinize')
+                    state = rootstate.clone()
+                    if stats is not None:
+                        stats.calls['clone'] += 1
+                        stats.count_calls(state)
+                    determinizer.randomize(state)
+
+                    node, depth = _descend(state, tree, exploration, expand, observer, None, stats)
+                    # Steer the rest of the batch away from this path until it has a result
+                    tree.add_virtual_loss(node)
+                    leaves.append((node, state))
+                    if stats is not None and depth > stats.max_depth:
+                        stats.max_depth = depth
+
+                # Simulate, solving the leaves that are small enough and playing
+                # out the rest
+                if stats is not None:
+                    stats.begin_phase('simulate')
+                solved = []
+                if endgame_size is not None:
+                    unsolved = []
+                    for leaf in leaves:
+                        results = leaf[1].solve(endgame_size, endgame_memo)
+                        if results is None:
+                            unsolved.append(leaf)
+                        else:
+                            solved.append((leaf[0], SolvedState(results)))
+                    leaves = unsolved
+                rollout_moves = []
+                if leaves:
+                    rollout_moves = rootstate.do_random_rollouts([leaf[1] for leaf in leaves],
+                                                                 random, rollout_depth)
+
+                # Backpropagate
+                if stats is not None:
+                    stats.begin_phase('backpropagate')
+                for ((node, state), moves) in zip(leaves, rollout_moves):
+                    if moves == rollout_depth:
+                        state = EvaluatedState(state)
+                    tree.backpropagate(node, state, virtual_loss=True)
+                for (node, state) in solved:
+                    tree.backpropagate(node, state, virtual_loss=True)
+                i += count
+
+                if stats is not None:
+                    stats.end_phase()
+                    stats.rollout_moves += sum(rollout_moves)
+                    stats.solved += len(solved)
+
+                if next_report is not None and i >= next_report:
+                    next_report = progress.update(i, tree)
+        else:
+            if rootstate.can_undo:
+                scratch = rootstate.clone()
+                undo_log = []
+                if stats is not None:
+                    stats.calls['clone'] += 1
+                    stats.count_calls(scratch)
+            else:
+                scratch = None
+                undo_log = None
+            while (itermax is None or i < itermax) and (i == 0 or deadline is None or time.time() < deadline):
+                if max_nodes is not None and expand and tree.node_count >= max_nodes:
+                    expand = tree.prune(int(max_nodes * PRUNE_TO)) > 0
+
+                # Determinize
+                if stats is not None:
+                    stats.begin_phase('determinize')
+                if scratch is not None:
+                    state = scratch
+                else:
+                    state = rootstate.clone()
+                    if stats is not None:
+                        stats.calls['clone'] += 1
+                        stats.count_calls(state)
+                determinizer.randomize(state)
+
+                node, depth = _descend(state, tree, exploration, expand, observer, undo_log, stats)
+
+                # Simulate, or solve the rest of the game if it is small enough
+                if stats is not None:
+                    stats.begin_phase('simulate')
+                results = None
+                if endgame_size is not None:
+                    results = state.solve(endgame_size, endgame_memo)
+                if results is None:
+                    rollout_moves = state.do_random_rollout(random, undo_log, rollout_depth)
+                else:
+                    rollout_moves = 0
+
+                # Backpropagate
+                if stats is not None:
+                    stats.begin_phase('backpropagate')
+                if results is not None:
+                    tree.backpropagate(node, SolvedState(results))
+                elif rollout_moves == rollout_depth:
+                    tree.backpropagate(node, EvaluatedState(state))
+                else:
+                    tree.backpropagate(node, state)
+
+                # Return the scratch state to the root
+                if undo_log is not None:
+                    if stats is not None:
+                        stats.begin_phase('undo')
+                    while undo_log:
+                        state.undo_move(undo_log.pop())
+                i += 1
+
+                if stats is not None:
+                    stats.end_phase()
+                    stats.rollout_moves += rollout_moves
+                    if results is not None:
+                        stats.solved += 1
+                    if depth > stats.max_depth:
+                        stats.max_depth = depth
+
+                if i == next_report:
+                    next_report = progress.update(i, tree)
+    elif tree.get_untried_moves(root, root_moves):
+        tree.add_child(root, root_moves[0], rootstate.player_to_move)
 
     # Output some information about the tree - can be omitted
     if verbose:
         term.clear_eol()
-        print rootnode.tree_to_string(0)
+        print tree.tree_to_string()
     elif not quiet:
         term.clear_eol()
-        print rootnode.children_to_string()
+        print tree.children_to_string()
+
+    if stats is not None:
+        stats.iterations = i
+        stats.node_count = tree.node_count
+
+    # Choose the move that was most visited
+    return SearchResult(tree.best_move(root_moves), i, time.time() - start, tree, stats)
+
+
+class SearchSession:
+    """
+    An ismcts search for one observer that keeps its tree from move to move.
+    Call search() whenever the observer is to move, and advance() with every move
+    that is actually played, by any player. advance() re-roots the tree on the
+    child for that move, so the work done on earlier turns carries over.
+    A session must only search states where its observer is the player to move,
+    as the tree is built from that player's determinizations.
+    """
+
+    def __init__(self, tree=None, exploration=0.7):
+        if tree is None:
+            tree = NodeTree()
+        self.tree = tree
+        self.exploration = exploration
+
+    def search(self, rootstate, itermax=None, verbose=False, quiet=False, time_budget=None,
+               determinizations=None, progress=None, profile=False, max_nodes=None,
+               max_bytes=None, batch_size=None, rollout_depth=None, endgame_size=None):
+        """ Continue growing the tree from rootstate, and return a SearchResult.
+        """
+        return ismcts_search(rootstate, itermax, verbose, quiet, self.exploration,
+                             self.tree, time_budget, determinizations, progress, profile,
+                             max_nodes, max_bytes, batch_size, rollout_depth, endgame_size)
+
+    def advance(self, move):
+        """ Record that move was played from the root state, keeping only its subtree.
+        """
+        self.tree = self.tree.subtree(move)
 
-    return max(rootnode.child_nodes, key=lambda
-        c: c.visits).move  # return the move that was most visited
+
+def pimc_values(rootstate, determinizations=20, memo=None):
+    """
+    Perfect information Monte Carlo: deal the cards hidden from the player to
+    move determinizations times, solve the state after each legal move in every
+    deal with solve(), and return {move: the average result for the player to
+    move}. memo is passed to solve(). rootstate must be solvable.
+    """
+    observer = rootstate.player_to_move
+    determinizer = Determinizer(rootstate, observer, determinizations)
+    if memo is None:
+        memo = {}
+    moves = rootstate.get_legal_moves()
+    totals = dict.fromkeys(moves, 0)
+    for i in xrange(determinizations):
+        state = rootstate.clone()
+        determinizer.randomize(state)
+        for move in moves:
+            child = state.clone()
+            child.do_move(move)
+            results = child.solve(None, memo)
+            if results is None:
+                raise Exception("%s can't be solved" % rootstate.__class__.__name__)
+            totals[move] += results[observer]
+    return {move: total / float(determinizations) for move, total in totals.iteritems()}
+
+
+def pimc(rootstate, determinizations=20, memo=None):
+    """
+    Return the move with the best average result over determinizations deals
+    of the hidden cards, each solved with perfect information (see pimc_values).
+    """
+    return max(pimc_values(rootstate, determinizations, memo).iteritems(),
+               key=lambda (move, value): value)[0]
+
+
+def _parallel_ismcts_worker(args):
+    """ Run one of the searches of parallel_ismcts, in a worker process.
+    """
+    rootstate, itermax, exploration, seed = args
+    # Each worker has its own random number stream
+    random.seed(seed)
+    tree = NodeTree()
+    ismcts(rootstate, itermax, quiet=True, exploration=exploration, tree=tree)
+    return tree.root_statistics()
+
+
+def parallel_ismcts(rootstate, itermax, workers=None, exploration=0.7, pool=None):
+    """
+    Conduct a root-parallel ismcts search of itermax iterations in total, split
+    between workers processes (by default one per CPU). Each worker grows its own
+    tree from its own determinizations; the statistics of the children of the
+    roots are then summed by move and the move with the most visits is returned.
+    pool is an optional multiprocessing.Pool to run the searches in, which saves
+    starting new processes for every search; workers must then be given.
+    There are never more workers than iterations, so every worker has at least one.
+    """
+    if pool is not None and workers is None:
+        raise Exception("parallel_ismcts needs the number of workers to run in a pool")
+    root_moves = rootstate.get_legal_moves()
+    if len(root_moves) == 1:
+        return root_moves[0]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, itermax))
+    jobs = [(rootstate, itermax // workers + (1 if i < itermax % workers else 0),
+             exploration, random.getrandbits(64))
+            for i in range(workers)]
+
+    if pool is None:
+        worker_pool = multiprocessing.Pool(workers)
+        try:
+            results = worker_pool.map(_parallel_ismcts_worker, jobs)
+        finally:
+            worker_pool.terminate()
+    else:
+        results = pool.map(_parallel_ismcts_worker, jobs)
+
+    return max(merge_root_statistics(results).iteritems(),
+               key=lambda (move, (wins, visits)): visits)[0]  # return the move that was most visited
+
+
+def merge_root_statistics(results):
+    """ Sum a list of {move: (wins, visits)} dictionaries by move.
+    """
+    merged = {}
+    for statistics in results:
+        for move, (move_wins, move_visits) in statistics.iteritems():
+            wins, visits = merged.get(move, (0, 0))
+            merged[move] = (wins + move_wins, visits + move_visits)
+    return merged
 
 
 #  try:
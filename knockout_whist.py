@@ -1,7 +1,49 @@
 #!/usr/bin/env python
-from copy import deepcopy
+from math import sqrt
 import random
-from framework import GameState, Card, ismcts
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from framework import GameState, Card, SearchSession, SUITS, SUIT_MASKS, card_set, \
+    card_set_key, zobrist_keys, cards_in, popcount, card_indexes, lowest_index, move_to_string, \
+    state_fields, SINGLE_MOVES, CARDS_BY_INDEX
+
+# All the cards in a Knockout Whist deck, where twos are low
+DECK_MASK = card_set(Card(rank, suit) for rank in xrange(2, 14 + 1) for suit in SUITS)
+
+# Zobrist keys for each part of a state, for up to 7 players. The card keys
+# are indexed by bit index.
+MAX_PLAYERS = 7
+_zobrist_rng = random.Random(0x3b1f57a2)
+HAND_KEYS = [zobrist_keys(64, _zobrist_rng) for player in xrange(MAX_PLAYERS + 1)]
+HAND_SIZE_KEYS = [zobrist_keys(8, _zobrist_rng) for player in xrange(MAX_PLAYERS + 1)]
+# A card played to the current trick by each player
+TRICK_KEYS = [zobrist_keys(64, _zobrist_rng) for player in xrange(MAX_PLAYERS + 1)]
+DISCARD_KEYS = zobrist_keys(64, _zobrist_rng)
+TRICKS_TAKEN_KEYS = [zobrist_keys(8, _zobrist_rng) for player in xrange(MAX_PLAYERS + 1)]
+KNOCKED_OUT_KEYS = zobrist_keys(MAX_PLAYERS + 1, _zobrist_rng)
+LEADER_KEYS = zobrist_keys(MAX_PLAYERS + 1, _zobrist_rng)
+PLAYER_TO_MOVE_KEYS = zobrist_keys(MAX_PLAYERS + 1, _zobrist_rng)
+OBSERVER_KEYS = zobrist_keys(MAX_PLAYERS + 1, _zobrist_rng)
+ROUND_KEYS = zobrist_keys(8, _zobrist_rng)
+TRUMP_KEYS = dict(zip([None] + list(SUITS), zobrist_keys(len(SUITS) + 1, _zobrist_rng)))
+
+if numpy is not None:
+    # The suit (an index into SUITS) of each card index, and its bit
+    CARD_SUITS = numpy.arange(52) & 3
+    CARD_BITS = numpy.int64(1) << numpy.arange(52, dtype=numpy.int64)
+    # The strength of each card in a trick, by lead suit, trump suit and card
+    # index: a trump beats any card of the lead suit, which beats anything else.
+    # The extra last entry is for the -1 of a player who hasn't played.
+    TRICK_STRENGTH = numpy.zeros((4, 4, 53), dtype=numpy.int8)
+    for _lead in xrange(4):
+        for _trump in xrange(4):
+            for _index in xrange(52):
+                if _index & 3 == _trump:
+                    TRICK_STRENGTH[_lead, _trump, _index] = 20 + (_index >> 2)
+                elif _index & 3 == _lead:
+                    TRICK_STRENGTH[_lead, _trump, _index] = 1 + (_index >> 2)
 
 
 class KnockoutWhistState(GameState):
@@ -11,88 +53,137 @@ class KnockoutWhistState(GameState):
         and the trump suit for each round is picked randomly rather than being chosen by one of the players.
     """
 
-    def __init__(self, n):
+    can_undo = True
+
+    def __init__(self, n, deal=True):
         """ Initialise the game state. n is the number of players (from 2 to 7).
+            The cards are dealt unless deal is False.
             """
         GameState.__init__(self)
         self.number_of_players = n
         self.player_to_move = 1
         self.tricks_in_round = 7
-        self.player_hands = {p: [] for p in xrange(1, self.number_of_players + 1)}
-        self.discards = []
+        # Hands and discards are card sets (see framework.card_set)
+        self.player_hands = {p: 0 for p in xrange(1, self.number_of_players + 1)}
+        self.discards = 0
         self.current_trick = []
+        # The discards and the cards in the current trick, which everyone has seen
+        self.played_cards = 0
         self.trump_suit = None
         self.tricks_taken = {}
         self.knocked_out = {p: False for p in
                            xrange(1, self.number_of_players + 1)}
-        self._deal()
+        # Zobrist keys of the hands and of everything else, kept up to date by
+        # do_move. Dealing sets them.
+        self.hand_keys = {}
+        self.public_key = 0
+        if deal:
+            self._deal()
 
     def clone(self):
         """ Create a deep clone of this game state.
         """
-        st = KnockoutWhistState(self.number_of_players)
+        st = KnockoutWhistState(self.number_of_players, deal=False)
         st.player_to_move = self.player_to_move
         st.tricks_in_round = self.tricks_in_round
-        st.player_hands = deepcopy(self.player_hands)
-        st.discards = deepcopy(self.discards)
-        st.current_trick = deepcopy(self.current_trick)
+        st.player_hands = dict(self.player_hands)
+        st.discards = self.discards
+        st.current_trick = list(self.current_trick)
+        st.played_cards = self.played_cards
         st.trump_suit = self.trump_suit
-        st.tricks_taken = deepcopy(self.tricks_taken)
-        st.knocked_out = deepcopy(self.knocked_out)
+        st.tricks_taken = dict(self.tricks_taken)
+        st.knocked_out = dict(self.knocked_out)
+        st.hand_keys = dict(self.hand_keys)
+        st.public_key = self.public_key
         return st
 
-    def clone_and_randomize(self, observer):
-        """ Create a deep clone of this game state, randomizing any information
-        not visible to the specified observer player.
+    def _status_key(self):
+        """ Return the Zobrist key of the player to move, the trump suit, the
+            round and the leader of the current trick.
         """
-        st = self.clone()
+        key = PLAYER_TO_MOVE_KEYS[self.player_to_move] ^ TRUMP_KEYS[self.trump_suit] ^ \
+            ROUND_KEYS[self.tricks_in_round]
+        if self.current_trick:
+            key ^= LEADER_KEYS[self.current_trick[0][0]]
+        return key
 
+    def rehash(self):
+        """ Compute the Zobrist keys from scratch. Must be called whenever the
+            state is changed, other than through do_move().
+        """
+        self.hand_keys = {p: card_set_key(hand, HAND_KEYS[p])
+                          for (p, hand) in self.player_hands.iteritems()}
+        key = self._status_key() ^ card_set_key(self.discards, DISCARD_KEYS)
+        for (player, card) in self.current_trick:
+            key ^= TRICK_KEYS[player][card.index]
+        for p in xrange(1, self.number_of_players + 1):
+            key ^= HAND_SIZE_KEYS[p][popcount(self.player_hands[p])] ^ \
+                TRICKS_TAKEN_KEYS[p][self.tricks_taken.get(p, 0)]
+            if self.knocked_out[p]:
+                key ^= KNOCKED_OUT_KEYS[p]
+        self.public_key = key
+
+    def zobrist_key(self):
+        """ Return a 64-bit Zobrist key of the whole state.
+        """
+        key = self.public_key
+        for hand_key in self.hand_keys.itervalues():
+            key ^= hand_key
+        return key
+
+    def information_set_key(self, observer=None):
+        """ Return a 64-bit Zobrist key of what the observer (by default the player
+            to move) can see: everything but the other players' cards.
+        """
+        if observer is None:
+            observer = self.player_to_move
+        return self.public_key ^ self.hand_keys[observer] ^ OBSERVER_KEYS[observer]
+
+    def get_hidden_cards(self, observer):
+        """ Return the card set of the cards the observer has not seen, and the
+            sizes of the other players' hands.
+        """
         # The observer can see his own hand and the cards in the current trick,
         # and can remember the cards played in previous tricks
-        seen_cards = st.player_hands[observer] + st.discards + \
-                     [card for (player, card) in st.current_trick]
-
-        # The observer can't see the rest of the deck
-        unseen_cards = [card for card in st._get_card_deck()
-                        if card not in seen_cards]
-
-        # _deal the unseen cards to the other players
-        random.shuffle(unseen_cards)
-        for p in xrange(1, st.number_of_players + 1):
-            if p != observer:
-                # _deal cards to player p
-                # Store the size of player p's hand
-                num_cards = len(self.player_hands[p])
-                # Give player p the first num_cards unseen cards
-                st.player_hands[p] = unseen_cards[:num_cards]
-                # Remove those cards from unseen_cards
-                unseen_cards = unseen_cards[num_cards:]
+        unseen = DECK_MASK & ~(self.player_hands[observer] | self.played_cards)
+        return unseen, [(p, popcount(self.player_hands[p]))
+                        for p in xrange(1, self.number_of_players + 1)
+                        if p != observer and self.player_hands[p]]
 
-        return st
+    def set_hidden_hands(self, hands):
+        """ Replace the hands of the players in a list of (player, card set) pairs.
+        """
+        for (player, hand) in hands:
+            self.player_hands[player] = hand
+            self.hand_keys[player] = card_set_key(hand, HAND_KEYS[player])
+        self.invalidate_moves()
 
     @staticmethod
     def _get_card_deck():
         """ Construct a standard deck of 52 cards.
         """
         return [Card(rank, suit) for rank in xrange(2, 14 + 1) for suit in
-                ['C', 'D', 'H', 'S']]
+                SUITS]
 
     def _deal(self):
         """ Reset the game state for the beginning of a new round, and _deal the cards.
         """
-        self.discards = []
+        self.discards = 0
         self.current_trick = []
+        self.played_cards = 0
         self.tricks_taken = {p: 0 for p in xrange(1, self.number_of_players + 1)}
 
         # Construct a deck, shuffle it, and _deal it to the players
         deck = self._get_card_deck()
         random.shuffle(deck)
         for p in xrange(1, self.number_of_players + 1):
-            self.player_hands[p] = deck[:self.tricks_in_round]
+            self.player_hands[p] = card_set(deck[:self.tricks_in_round])
             deck = deck[self.tricks_in_round:]
 
         # Choose the trump suit for this round
         self.trump_suit = random.choice(['C', 'D', 'H', 'S'])
+        if self.hashing:
+            self.rehash()
 
     def get_next_player(self, p):
         """ Return the player to the left of the specified player, skipping players who have been knocked out
@@ -106,12 +197,34 @@ class KnockoutWhistState(GameState):
     def do_move(self, move):
         """ update a state by carrying out the given move.
             Must update player_to_move.
+            Return a token for undo_move.
         """
+        self.invalidate_moves()
+        mover = self.player_to_move
+        hand = self.player_hands[mover]
+        played_cards = self.played_cards
+        hand_key = self.hand_keys[mover]
+        public_key = self.public_key
+        trick_token = None
+        round_token = None
+        hashing = self.hashing
+        if hashing:
+            # Take out the keys of what the move changes, and put them back in afterwards
+            key = public_key ^ self._status_key()
+
         # Store the played card in the current trick
-        self.current_trick.append((self.player_to_move, move))
+        played_card = CARDS_BY_INDEX[lowest_index(move)]
+        self.current_trick.append((mover, played_card))
 
         # Remove the card from the player's hand
-        self.player_hands[self.player_to_move].remove(move)
+        index = played_card.index
+        self.player_hands[mover] = hand & ~(1 << index)
+        self.played_cards |= 1 << index
+        if hashing:
+            self.hand_keys[mover] = hand_key ^ HAND_KEYS[mover][index]
+            size = popcount(hand)
+            key ^= TRICK_KEYS[mover][index] ^ HAND_SIZE_KEYS[mover][size] ^ \
+                HAND_SIZE_KEYS[mover][size - 1]
 
         # Find the next player
         self.player_to_move = self.get_next_player(self.player_to_move)
@@ -131,14 +244,25 @@ class KnockoutWhistState(GameState):
             # The winning play is the last element in sorted_plays
             trick_winner = sorted_plays[-1][0]
 
-            # update the game state
-            self.tricks_taken[trick_winner] += 1
-            self.discards += [card for (player, card) in self.current_trick]
+            # update the game state, keeping what undo_move needs to reverse it
+            old_trick = self.current_trick
+            old_discards = self.discards
+            taken = self.tricks_taken[trick_winner]
+            self.tricks_taken[trick_winner] = taken + 1
+            if hashing:
+                key ^= TRICKS_TAKEN_KEYS[trick_winner][taken] ^ \
+                    TRICKS_TAKEN_KEYS[trick_winner][taken + 1]
+                for (player, card) in self.current_trick:
+                    key ^= TRICK_KEYS[player][card.index] ^ DISCARD_KEYS[card.index]
+            self.discards |= card_set(card for (player, card) in self.current_trick)
             self.current_trick = []
             self.player_to_move = trick_winner
 
             # If the next player's hand is empty, this round is over
             if not self.player_hands[self.player_to_move]:
+                # Dealing replaces everything but the hands, which it changes in place
+                round_token = (dict(self.player_hands), dict(self.hand_keys), self.tricks_taken,
+                               self.knocked_out, self.tricks_in_round, self.trump_suit)
                 self.tricks_in_round -= 1
                 self.knocked_out = {
                 p: (self.knocked_out[p] or self.tricks_taken[p] == 0) for p in
@@ -150,35 +274,124 @@ class KnockoutWhistState(GameState):
 
                 self._deal()
 
+            trick_token = (old_trick, old_discards, trick_winner, round_token)
+
+        if hashing and round_token is None:
+            # Dealing a new round rehashes the whole state
+            self.public_key = key ^ self._status_key()
+        return (mover, hand, played_cards, hand_key, public_key, trick_token)
+
+    def undo_move(self, token):
+        """ Undo the move that do_move returned token for.
+        """
+        self.invalidate_moves()
+        (mover, hand, self.played_cards, hand_key, self.public_key, trick_token) = token
+        if trick_token is not None:
+            # The move finished a trick
+            (self.current_trick, self.discards, trick_winner, round_token) = trick_token
+            if round_token is not None:
+                # The move finished a round
+                (hands, hand_keys, self.tricks_taken, self.knocked_out, self.tricks_in_round,
+                 self.trump_suit) = round_token
+                self.player_hands.update(hands)
+                self.hand_keys.update(hand_keys)
+            self.tricks_taken[trick_winner] -= 1
+        self.current_trick.pop()
+        self.player_hands[mover] = hand
+        self.hand_keys[mover] = hand_key
+        self.player_to_move = mover
+
     def get_moves(self):
         """ Get all possible moves from this state.
         """
+        # Each move plays a single card
+        return [SINGLE_MOVES[index] for index in card_indexes(self._legal_cards())]
+
+    def _legal_cards(self):
+        """ Return the card set of the cards the player to move may play.
+        """
         hand = self.player_hands[self.player_to_move]
-        if not self.current_trick:
-            # May lead a trick with any card
-            return hand
-        else:
+        if self.current_trick:
             (leader, lead_card) = self.current_trick[0]
             # Must follow suit if it is possible to do so
-            cards_in_suit = [card for card in hand if card.suit == lead_card.suit]
+            cards_in_suit = hand & SUIT_MASKS[lead_card.suit]
             if cards_in_suit:
                 return cards_in_suit
-            else:
-                # Can't follow suit, so can play any card
-                return hand
+            # Otherwise can't follow suit, so can play any card
+        # May lead a trick with any card
+        return hand
+
+    def get_random_move(self, rng):
+        """ Return a random legal move. Every legal card is equally likely to be
+            played, as when choosing from get_moves(), but no list of moves is built.
+        """
+        cards = self._legal_cards()
+        if not cards:
+            return None
+        return SINGLE_MOVES[card_indexes(cards)[rng.randrange(popcount(cards))]]
+
+    def is_game_over(self):
+        """ Return whether the game has ended, i.e. the player to move has no cards.
+        """
+        return not self.player_hands[self.player_to_move]
+
+    def do_random_rollouts(self, states, rng, max_moves=None):
+        """ Play random games from every state in states to the end, or for at
+            most max_moves moves, as do_random_rollout would, and return the number
+            of moves played in each. With numpy the states are played together, in
+            lockstep, by batch_rollouts; rng only seeds the random numbers they use.
+        """
+        if numpy is None:
+            return GameState.do_random_rollouts(self, states, rng, max_moves)
+        num_moves = [0] * len(states)
+        random_state = numpy.random.RandomState(rng.getrandbits(32))
+        by_players = {}
+        for (i, state) in enumerate(states):
+            by_players.setdefault(state.number_of_players, []).append(i)
+        for indexes in by_players.itervalues():
+            for (i, moves) in zip(indexes, batch_rollouts([states[i] for i in indexes],
+                                                          random_state, max_moves)):
+                num_moves[i] = moves
+        return num_moves
 
     def get_result(self, player):
         """ Get the game result from the viewpoint of player.
         """
         return 0 if (self.knocked_out[player]) else 1
 
+    def evaluate(self, player):
+        """ Estimate the chance that player wins, as their share of the chances of
+            the players still in the game of surviving this round. A player who has
+            taken a trick survives it; otherwise they need to take one of the tricks
+            left, each of which they win with a chance that grows with their trumps.
+        """
+        if self.knocked_out[player]:
+            return 0.0
+        players = [p for p in xrange(1, self.number_of_players + 1) if not self.knocked_out[p]]
+        if len(players) == 1:
+            return 1.0
+        trumps = SUIT_MASKS[self.trump_suit] if self.trump_suit else 0
+        strength = {p: 1 + popcount(self.player_hands[p] & trumps) for p in players}
+        total_strength = float(sum(strength.itervalues()))
+        tricks_left = max(popcount(self.player_hands[p]) for p in players)
+        survival = {}
+        for p in players:
+            if self.tricks_taken.get(p, 0):
+                survival[p] = 1.0
+            else:
+                survival[p] = 1.0 - (1.0 - strength[p] / total_strength) ** tricks_left
+        total_survival = sum(survival.itervalues())
+        if not total_survival:
+            return 1.0 / len(players)
+        return survival[player] / total_survival
+
     def __repr__(self):
         """ Return a human-readable representation of the state
         """
         result = "Round %i" % self.tricks_in_round
         result += " | P%i: " % self.player_to_move
         result += ",".join(
-            str(card) for card in self.player_hands[self.player_to_move])
+            str(card) for card in cards_in(self.player_hands[self.player_to_move]))
         result += " | Tricks: %i" % self.tricks_taken[self.player_to_move]
         result += " | Trump: %s" % self.trump_suit
         result += " | Trick: ["
@@ -188,20 +401,144 @@ class KnockoutWhistState(GameState):
         return result
 
 
+def batch_rollouts(states, random_state, max_moves=None):
+    """ Play random games to the end, or for at most max_moves moves, from a list
+        of states with the same number of players, all at once with numpy arrays,
+        and return the number of moves played in each. random_state is the
+        numpy.random.RandomState to use.
+        Every card is played as by get_random_move, so the results are distributed
+        as with do_random_rollout, but the random numbers differ.
+    """
+    num_games = len(states)
+    n = states[0].number_of_players
+    games = numpy.arange(num_games)
+    players = numpy.arange(n)
+
+    # Players are numbered from 0, and hold a row of 52 booleans, one per card index
+    masks = numpy.array([[state.player_hands[p] for p in xrange(1, n + 1)] for state in states],
+                        dtype=numpy.int64)
+    hands = (masks[:, :, None] >> numpy.arange(52)) & 1 == 1
+    discards = numpy.array([state.discards for state in states], dtype=numpy.int64)
+    # The card index each player has played to the current trick, or -1, and
+    # the leader and lead suit of the trick, or -1
+    trick = numpy.full((num_games, n), -1, dtype=numpy.int64)
+    leader = numpy.full(num_games, -1, dtype=numpy.int64)
+    lead_suit = numpy.full(num_games, -1, dtype=numpy.int64)
+    for (g, state) in enumerate(states):
+        for (player, card) in state.current_trick:
+            trick[g, player - 1] = card.index
+        if state.current_trick:
+            leader[g] = state.current_trick[0][0] - 1
+            lead_suit[g] = state.current_trick[0][1].index & 3
+    to_move = numpy.array([state.player_to_move - 1 for state in states])
+    trump = numpy.array([SUITS.index(state.trump_suit) if state.trump_suit else 0
+                         for state in states])
+    taken = numpy.array([[state.tricks_taken.get(p, 0) for p in xrange(1, n + 1)]
+                         for state in states])
+    out = numpy.array([[state.knocked_out[p] for p in xrange(1, n + 1)] for state in states])
+    tricks_in_round = numpy.array([state.tricks_in_round for state in states])
+    num_moves = numpy.zeros(num_games, dtype=numpy.int64)
+
+    # The games still being played
+    active = games[hands[games, to_move].any(axis=1)]
+    while len(active):
+        mover = to_move[active]
+        hand = hands[active, mover]
+
+        # Play a random legal card, following suit if possible
+        lead = lead_suit[active]
+        suited = hand & (CARD_SUITS == lead[:, None])
+        legal = numpy.where(suited.any(axis=1)[:, None], suited, hand)
+        card = numpy.where(legal, random_state.random_sample(legal.shape), -1.0).argmax(axis=1)
+        hands[active, mover, card] = False
+        trick[active, mover] = card
+        leader[active] = numpy.where(lead < 0, mover, leader[active])
+        lead_suit[active] = numpy.where(lead < 0, card & 3, lead)
+        num_moves[active] += 1
+
+        # The next player who hasn't been knocked out
+        seats = (mover[:, None] + players + 1) % n
+        next_player = seats[numpy.arange(len(active)), (~out[active[:, None], seats]).argmax(axis=1)]
+
+        # If the next player has already played in this trick, then the trick is over
+        over = trick[active, next_player] >= 0
+        done = active[over]
+        if len(done):
+            strength = TRICK_STRENGTH[lead_suit[done][:, None], trump[done][:, None], trick[done]]
+            winner = strength.argmax(axis=1)
+            taken[done, winner] += 1
+            discards[done] |= numpy.where(trick[done] >= 0, CARD_BITS[trick[done]], 0).sum(axis=1)
+            trick[done] = -1
+            leader[done] = -1
+            lead_suit[done] = -1
+            next_player[over] = winner
+
+            # If the winner's hand is empty, this round is over
+            ended = done[~hands[done, winner].any(axis=1)]
+            if len(ended):
+                out[ended] |= taken[ended] == 0
+                tricks_in_round[ended] -= 1
+                # If all but one players are now knocked out, the game is over
+                tricks_in_round[ended[(~out[ended]).sum(axis=1) <= 1]] = 0
+                taken[ended] = 0
+                discards[ended] = 0
+                _batch_deal(hands, ended, tricks_in_round[ended], random_state)
+                trump[ended] = random_state.randint(4, size=len(ended))
+        to_move[active] = next_player
+        active = active[hands[active, to_move[active]].any(axis=1)]
+        if max_moves is not None:
+            active = active[num_moves[active] < max_moves]
+
+    masks = (hands * CARD_BITS).sum(axis=2)
+    for (g, state) in enumerate(states):
+        state.player_hands = {p: int(masks[g, p - 1]) for p in xrange(1, n + 1)}
+        state.discards = int(discards[g])
+        # The trick was played in seat order from the leader
+        state.current_trick = [(seat + 1, CARDS_BY_INDEX[trick[g, seat]])
+                               for seat in (leader[g] + players) % n if trick[g, seat] >= 0]
+        state.played_cards = state.discards | card_set(card for (p, card) in state.current_trick)
+        state.tricks_taken = {p: int(taken[g, p - 1]) for p in xrange(1, n + 1)}
+        state.knocked_out = {p: bool(out[g, p - 1]) for p in xrange(1, n + 1)}
+        state.tricks_in_round = int(tricks_in_round[g])
+        state.trump_suit = SUITS[trump[g]]
+        state.player_to_move = int(to_move[g]) + 1
+        state.invalidate_moves()
+        if state.hashing:
+            state.rehash()
+    return [int(moves) for moves in num_moves]
+
+
+def _batch_deal(hands, games, sizes, random_state):
+    """ Deal a new round in each of games of the hands array of batch_rollouts,
+        with sizes cards to every player, from a shuffled deck.
+    """
+    n = hands.shape[1]
+    hands[games] = False
+    # The card at each position of each game's shuffled deck
+    decks = random_state.random_sample((len(games), 52)).argsort(axis=1)
+    positions = numpy.arange(52)
+    rows, columns = numpy.nonzero(positions < n * sizes[:, None])
+    hands[games[rows], columns // sizes[rows], decks[rows, columns]] = True
+
+
 def play_game():
     """ Play a sample game between two ismcts players.
     """
     state = KnockoutWhistState(4)
+    # Each player keeps its own search tree from move to move
+    sessions = {p: SearchSession() for p in xrange(1, state.number_of_players + 1)}
 
-    while state.get_moves():
+    while state.get_legal_moves():
         print str(state)
         # Use different numbers of iterations (simulations, tree nodes) for different players
         if state.player_to_move == 1:
-            m = ismcts(rootstate=state, itermax=1000, verbose=False)
+            m = sessions[1].search(rootstate=state, itermax=1000, verbose=False).move
         else:
-            m = ismcts(rootstate=state, itermax=100, verbose=False)
-        print "Best Move: " + str(m) + "\n"
+            m = sessions[state.player_to_move].search(rootstate=state, itermax=100, verbose=False).move
+        print "Best Move: " + move_to_string(m) + "\n"
         state.do_move(m)
+        for session in sessions.itervalues():
+            session.advance(m)
 
     someone_won = False
     for p in xrange(1, state.number_of_players + 1):
@@ -212,5 +549,123 @@ def play_game():
         print "Nobody wins!"
 
 
+def test_undo_move(num_games=200):
+    """ Check that undo_move returns the state to what it was before do_move, for
+        every move of num_games random games with 2 to 7 players, and that undoing
+        a whole game returns it to the deal.
+    """
+    for game_num in range(num_games):
+        state = KnockoutWhistState(2 + game_num % 6)
+        dealt = state_fields(state)
+        tokens = []
+        while state.get_legal_moves():
+            before = state_fields(state)
+            move = random.choice(state.get_legal_moves())
+            state.undo_move(state.do_move(move))
+            assert state_fields(state) == before, (state, move_to_string(move))
+            assert set(state.get_legal_moves()) == set(state.get_moves()), state
+            # Redo the move and carry on
+            tokens.append(state.do_move(move))
+        while tokens:
+            state.undo_move(tokens.pop())
+        assert state_fields(state) == dealt, state
+    print "undo_move reverses do_move in %s games" % num_games
+
+
+def test_zobrist_keys(num_games=200):
+    """ Check that the Zobrist keys that do_move and undo_move keep up to date
+        equal the keys computed from scratch by rehash, and that randomizing the
+        hidden cards leaves the observer's information_set_key alone, in every
+        state of num_games random games with 2 to 7 players.
+    """
+    def check_keys(state):
+        fresh = state.clone()
+        fresh.rehash()
+        assert state.zobrist_key() == fresh.zobrist_key(), state
+        for p in xrange(1, state.number_of_players + 1):
+            assert state.information_set_key(p) == fresh.information_set_key(p), state
+            assert state.clone_and_randomize(p).information_set_key(p) == \
+                state.information_set_key(p), state
+
+    for game_num in range(num_games):
+        state = KnockoutWhistState(2 + game_num % 6)
+        check_keys(state)
+        while state.get_legal_moves():
+            move = random.choice(state.get_legal_moves())
+            state.undo_move(state.do_move(move))
+            check_keys(state)
+            state.do_move(move)
+            check_keys(state)
+    print "Zobrist keys match rehash in %s games" % num_games
+
+
+def test_batch_rollouts(num_games=50, num_positions=10, num_rollouts=1000):
+    """ Check batch_rollouts against the scalar rollouts. In every state of
+        num_games random games with 2 to 7 players, a batched step must leave each
+        game as do_move would leave it after one of its legal moves, except for
+        the cards of a new round, which must be a fresh deal. From num_positions
+        positions, the win rate of the player to move and the mean number of
+        moves of num_rollouts batched rollouts must be within four standard
+        errors of those of as many do_random_rollout calls.
+    """
+    def round_fields(state):
+        return (state.tricks_in_round, state.knocked_out, state.player_to_move)
+
+    random_state = numpy.random.RandomState(0)
+    for game_num in range(num_games):
+        state = KnockoutWhistState(2 + game_num % 6)
+        while state.get_legal_moves():
+            expected = []
+            new_rounds = []
+            for move in state.get_legal_moves():
+                child = state.clone()
+                child.do_move(move)
+                if child.tricks_in_round == state.tricks_in_round:
+                    expected.append(state_fields(child))
+                else:
+                    new_rounds.append(round_fields(child))
+            batch = [state.clone() for i in range(8)]
+            assert batch_rollouts(batch, random_state, 1) == [1] * len(batch), state
+            for child in batch:
+                if child.tricks_in_round == state.tricks_in_round:
+                    assert state_fields(child) in expected, (state, child)
+                    continue
+                assert round_fields(child) in new_rounds, (state, child)
+                assert not child.discards and not child.current_trick, child
+                assert not any(child.tricks_taken.itervalues()), child
+                dealt = 0
+                for hand in child.player_hands.itervalues():
+                    assert popcount(hand) == child.tricks_in_round and not hand & dealt, child
+                    dealt |= hand
+                fresh = child.clone()
+                fresh.rehash()
+                assert child.zobrist_key() == fresh.zobrist_key(), child
+            state.do_move(random.choice(state.get_legal_moves()))
+
+    positions = []
+    while len(positions) < num_positions:
+        state = KnockoutWhistState(2 + len(positions) % 6)
+        state.do_random_rollout(random, max_moves=random.randrange(30))
+        if state.get_legal_moves():
+            positions.append(state)
+    for state in positions:
+        player = state.player_to_move
+        scalar = [state.clone() for i in range(num_rollouts)]
+        scalar_moves = [child.do_random_rollout(random) for child in scalar]
+        batch = [state.clone() for i in range(num_rollouts)]
+        batch_moves = batch_rollouts(batch, random_state)
+        for child in batch:
+            assert child.is_game_over(), child
+        for (scalar_values, batch_values) in (
+                ([child.get_result(player) for child in scalar], [child.get_result(player) for child in batch]),
+                (scalar_moves, batch_moves)):
+            scalar_values = numpy.array(scalar_values, dtype=float)
+            batch_values = numpy.array(batch_values, dtype=float)
+            error = sqrt((scalar_values.var() + batch_values.var()) / num_rollouts)
+            assert abs(scalar_values.mean() - batch_values.mean()) <= 4 * error + 1e-9, state
+    print "batch_rollouts matches do_random_rollout in %s games and %s positions" % (
+        num_games, num_positions)
+
+
 if __name__ == "__main__":
     play_game()
\ No newline at end of file
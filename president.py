@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 from copy import copy
-from operator import attrgetter
+from math import exp, sqrt
 import random
 import sys
 
 from blessings import Terminal
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from framework import GameState, Card, ismcts, Deck
+from framework import GameState, Card, ismcts, SearchSession, TranspositionTree, Deck, card_set, cards_in, \
+    state_fields, card_set_key, zobrist_keys, popcount, card_bit, highest_index, index_rank, lowest_index, card_indexes, \
+    make_move, move_kind, move_cards, move_to_string, PASS, SINGLE_MOVES, \
+    MOVE_KIND_SHIFT, MOVE_SINGLE, MOVE_COMBO, MOVE_STRAIGHT, MOVE_PASS
 
 
 # TODO:
@@ -20,8 +27,132 @@ from framework import GameState, Card, ismcts, Deck
 # run exclusivity
 # Make sure sorted
 CLEAN_PACK = Deck().cards
+CLEAN_PACK_MASK = card_set(CLEAN_PACK)
 term = Terminal()
 
+
+def _combo_suits(size, suits):
+    """
+    Return the ways of playing a combo of the given size from the suits of a
+    rank (a nibble of a card set), as nibbles. Any two suits make a pair, but
+    trips and quads are only made of suits that are next to each other in
+    suit order.
+    """
+    bits = [1 << suit for suit in xrange(4) if suits & (1 << suit)]
+    if size == 2:
+        return [a | b for i, a in enumerate(bits) for b in bits[i + 1:]]
+    return [sum(bits[i:i + size]) for i in xrange(len(bits) - size + 1)]
+
+# COMBO_SUITS[size][suits] lists the combos of that size for a rank holding those suits
+COMBO_SUITS = {size: [_combo_suits(size, suits) for suits in xrange(16)]
+               for size in (2, 3, 4)}
+# LEAD_COMBO_SUITS[suits] lists the combos of every size, for leading a trick
+LEAD_COMBO_SUITS = [COMBO_SUITS[2][suits] + COMBO_SUITS[3][suits] + COMBO_SUITS[4][suits]
+                    for suits in xrange(16)]
+
+# STRAIGHT_SPANS[length] is the card set of a run of that length starting at bit 0
+STRAIGHT_SPANS = [sum(1 << (4 * i) for i in xrange(length)) for length in xrange(15)]
+
+
+def run_starts(cards, length):
+    """ Return the card set of the cards in cards that start a same-suit run of
+        at least the given length.
+    """
+    starts = cards
+    for i in xrange(1, length):
+        starts &= cards >> (4 * i)
+    return starts
+
+
+# The lowest bit of every rank, for counting the ranks in a card set
+RANK_LOW_BITS = sum(1 << (4 * i) for i in xrange(16))
+# The aces and twos, the highest cards
+HIGH_CARDS = card_set(card for card in CLEAN_PACK if card.rank >= 14)
+
+
+def ranks_held(cards):
+    """ Return the number of ranks that a card set has cards of.
+    """
+    cards |= cards >> 1
+    cards |= cards >> 2
+    return popcount(cards & RANK_LOW_BITS)
+
+
+# The weights of PresidentGameState.evaluate, from a logistic regression of
+# the results of random rollouts on these features of random positions, as
+# fitted by benchmarks.fit_evaluation_weights() with its defaults: 20,000
+# positions, each from a new random game, with seed 0 (rounded)
+EVALUATION_WEIGHTS = {"cards": 0.12, "ranks": 0.13, "high_cards": 0.25, "to_move": 0.06}
+
+COMBO_TAG = MOVE_COMBO << MOVE_KIND_SHIFT
+STRAIGHT_TAG = MOVE_STRAIGHT << MOVE_KIND_SHIFT
+
+# Zobrist keys for each part of a state. The card keys are indexed by bit index.
+_zobrist_rng = random.Random(0x9e51de47)
+HAND_KEYS = [zobrist_keys(64, _zobrist_rng) for player in (0, 1)]
+HAND_SIZE_KEYS = [zobrist_keys(64, _zobrist_rng) for player in (0, 1)]
+DISCARD_KEYS = zobrist_keys(64, _zobrist_rng)
+TABLE_KEYS = zobrist_keys(64, _zobrist_rng)
+# Moving a card from the table to the discards
+TABLE_TO_DISCARD_KEYS = [table ^ discard for (table, discard) in zip(TABLE_KEYS, DISCARD_KEYS)]
+# The cards of the last play on the table, which the next play must beat
+TOP_KEYS = zobrist_keys(64, _zobrist_rng)
+# Playing a card, which puts it on the table and on top
+PLAY_KEYS = [table ^ top for (table, top) in zip(TABLE_KEYS, TOP_KEYS)]
+TABLE_LENGTH_KEYS = zobrist_keys(64, _zobrist_rng)
+COMBO_SIZE_KEYS = zobrist_keys(16, _zobrist_rng)
+STRAIGHT_LENGTH_KEYS = zobrist_keys(16, _zobrist_rng)
+CONSECUTIVE_KEYS = zobrist_keys(2, _zobrist_rng)
+PLAYER_TO_MOVE_KEYS = zobrist_keys(2, _zobrist_rng)
+OBSERVER_KEYS = zobrist_keys(2, _zobrist_rng)
+
+
+def _nibble_moves(row, suits):
+    """
+    Return the suits (as nibbles) of the single cards and combos that can be
+    played from a rank holding the given suits, for batch_rollouts. row 0 is
+    for leading a trick (singles and every combo), 1 for following singles, 2
+    to 4 for following combos of that size and 5 for following a straight.
+    """
+    singles = [1 << suit for suit in xrange(4) if suits & (1 << suit)]
+    if row == 0:
+        return singles + LEAD_COMBO_SUITS[suits]
+    if row == 1:
+        return singles
+    if row <= 4:
+        return COMBO_SUITS[row][suits]
+    return []
+
+if numpy is not None:
+    # NIBBLE_MOVE_COUNTS[row, suits] is the number of _nibble_moves(row, suits),
+    # and NIBBLE_MOVE_SUITS[row, suits] lists them
+    NIBBLE_MOVE_COUNTS = numpy.array([[len(_nibble_moves(row, suits)) for suits in xrange(16)]
+                                      for row in xrange(6)])
+    NIBBLE_MOVE_SUITS = numpy.zeros((6, 16, NIBBLE_MOVE_COUNTS.max()), dtype=numpy.int64)
+    for _row in xrange(6):
+        for _suits in xrange(16):
+            _moves = _nibble_moves(_row, _suits)
+            NIBBLE_MOVE_SUITS[_row, _suits, :len(_moves)] = _moves
+    NIBBLES = numpy.arange(14)
+    NIBBLE_SHIFTS = 4 * NIBBLES
+    BIT_SHIFTS = numpy.arange(56)
+    BYTE_POPCOUNTS = numpy.array([popcount(byte) for byte in xrange(256)])
+    STRAIGHT_SPAN_MASKS = numpy.array(STRAIGHT_SPANS, dtype=numpy.int64)
+
+
+def cards_to_move(cards):
+    """ Return the move that plays the given list of cards, or PASS if it is empty.
+    """
+    if not cards:
+        return PASS
+    if len(cards) == 1:
+        kind = MOVE_SINGLE
+    elif all(card.rank == cards[0].rank for card in cards):
+        kind = MOVE_COMBO
+    else:
+        kind = MOVE_STRAIGHT
+    return make_move(kind, card_set(cards))
+
 class PresidentGameState(GameState):
     """
     A state of the game President.
@@ -33,62 +164,98 @@ class PresidentGameState(GameState):
         Initialise the game state.
         Always have 2 players
 
+        Hands and discards are card sets (see framework.card_set). The table is
+        a list of the card sets played so far in the current trick.
         """
         GameState.__init__(self)
         self.player_to_move = 0
-        self.player_hands = [[],[]]
-        self.discards = []
+        self.player_hands = [0, 0]
+        self.discards = 0
         self.on_the_table = []
+        # The discards and the cards on the table, which both players have seen
+        self.played_cards = 0
         self.combo_size = 0
         self.consecutive_mode = 0
         self.straight_length = 0
+        # Zobrist keys of the hands and of everything else, kept up to date by do_move
+        self.hand_keys = [0, 0]
+        self.public_key = 0
+        self.rehash()
 
     def clone(self):
         """ Create a deep clone of this game state.
         """
         st = PresidentGameState()
         st.player_to_move = self.player_to_move
-        st.player_hands = [copy(self.player_hands[0]), copy(self.player_hands[1])]
-        st.discards = copy(self.discards)
+        st.player_hands = [self.player_hands[0], self.player_hands[1]]
+        st.discards = self.discards
         st.on_the_table = copy(self.on_the_table)
+        st.played_cards = self.played_cards
         st.combo_size = self.combo_size
         st.consecutive_mode = self.consecutive_mode
         st.straight_length = self.straight_length
+        st.hand_keys = [self.hand_keys[0], self.hand_keys[1]]
+        st.public_key = self.public_key
 
         return st
 
-    def clone_and_randomize(self, observer):
-        """ Create a deep clone of this game state, randomizing any information
-        not visible to the specified observer player.
+    def _status_key(self):
+        """ Return the Zobrist key of the modes, the number of plays on the table and the player to move.
         """
-        st = self.clone()
+        return COMBO_SIZE_KEYS[self.combo_size] ^ STRAIGHT_LENGTH_KEYS[self.straight_length] ^ \
+            CONSECUTIVE_KEYS[self.consecutive_mode] ^ PLAYER_TO_MOVE_KEYS[self.player_to_move] ^ \
+            TABLE_LENGTH_KEYS[len(self.on_the_table)]
 
-        # The observer can see his own hand and the cards in the current trick,
-        # and can remember the cards played in previous tricks
-        flattened_current_trick =  [a for b in st.on_the_table for a in b]
-        seen_cards = set(st.player_hands[observer] + st.discards + flattened_current_trick)
-
-        # The observer can't see the rest of the deck
-        unseen_cards = [card for card in CLEAN_PACK
-                        if card not in seen_cards]
+    def rehash(self):
+        """ Compute the Zobrist keys from scratch. Must be called whenever the
+            state is changed, other than through do_move().
+        """
+        self.hand_keys = [card_set_key(self.player_hands[p], HAND_KEYS[p]) for p in (0, 1)]
+        self.public_key = self._status_key() ^ \
+            card_set_key(self.discards, DISCARD_KEYS) ^ \
+            card_set_key(self.played_cards & ~self.discards, TABLE_KEYS) ^ \
+            (card_set_key(self.on_the_table[-1], TOP_KEYS) if self.on_the_table else 0) ^ \
+            HAND_SIZE_KEYS[0][popcount(self.player_hands[0])] ^ \
+            HAND_SIZE_KEYS[1][popcount(self.player_hands[1])]
+
+    def zobrist_key(self):
+        """ Return a 64-bit Zobrist key of the whole state.
+        """
+        return self.public_key ^ self.hand_keys[0] ^ self.hand_keys[1]
 
-        # deal the unseen cards to the player
-        random.shuffle(unseen_cards)
+    def information_set_key(self, observer=None):
+        """ Return a 64-bit Zobrist key of what the observer (by default the player
+            to move) can see: everything but the other player's cards.
+        """
+        if observer is None:
+            observer = self.player_to_move
+        return self.public_key ^ self.hand_keys[observer] ^ OBSERVER_KEYS[observer]
 
-        for p in (0,1):
-            if p != observer:
-                # deal cards to player p. The players start with 17 cards, so
-                # with two players there are 34 cards in total.
-                # The player should be dealt 34 - discards - num cards in other players hand.
+    can_undo = True
 
-                # Store the size of player p's hand
-                num_cards = 34 - len(st.discards) - len(st.player_hands[observer])
+    def get_hidden_cards(self, observer):
+        """ Return the card set of the cards the observer has not seen, and the
+            size of the other player's hand.
+        """
+        # The observer can see his own hand and the cards in the current trick,
+        # and can remember the cards played in previous tricks
+        unseen = CLEAN_PACK_MASK & ~(self.player_hands[observer] | self.played_cards)
 
-                # Give player p the first num_cards unseen cards
-                st.player_hands[p] = sorted(unseen_cards[:num_cards],
-                                            key=attrgetter('rank', 'suit'))
+        # The players start with 17 cards, so with two players there are 34 cards
+        # in total. The other player has the ones that aren't in the observer's hand
+        # or played.
+        num_cards = 34 - popcount(self.played_cards) - popcount(self.player_hands[observer])
+        return unseen, [(1 - observer, num_cards)]
 
-        return st
+    def set_hidden_hands(self, hands):
+        """ Replace the hands of the players in a list of (player, card set) pairs.
+        """
+        for (player, hand) in hands:
+            self.public_key ^= HAND_SIZE_KEYS[player][popcount(self.player_hands[player])] ^ \
+                HAND_SIZE_KEYS[player][popcount(hand)]
+            self.player_hands[player] = hand
+            self.hand_keys[player] = card_set_key(hand, HAND_KEYS[player])
+        self.invalidate_moves()
 
     def get_next_player(self, p):
         return (p + 1) % self.number_of_players
@@ -102,47 +269,72 @@ class PresidentGameState(GameState):
         deck.shuffle()
 
         # Player zero gets the first 17 cards
-        self.player_hands[0] = sorted(deck.cards[:17],
-                                      key=attrgetter('rank', 'suit'))
+        self.player_hands[0] = card_set(deck.cards[:17])
 
         # Player one gets the last 17 cards
-        self.player_hands[1] = sorted(deck.cards[-17:],
-                                      key=attrgetter('rank', 'suit'))
+        self.player_hands[1] = card_set(deck.cards[-17:])
+        self.rehash()
+        self.invalidate_moves()
 
     def do_move(self, move):
         """ update a state by carrying out the given move.
             Must update player_to_move.
+            Return a token for undo_move.
         """
-        # If the move is "PASS" then the current trick is over
-        if move is "PASS":
+        self.invalidate_moves()
+        player = self.player_to_move
+        # Everything the move can change. PASS replaces the table, so keep the old one.
+        token = (player, self.player_hands[player], self.discards, self.played_cards,
+                 self.on_the_table if move == PASS else None,
+                 self.combo_size, self.consecutive_mode, self.straight_length,
+                 self.hand_keys[player], self.public_key)
+        hashing = self.hashing
+        if hashing:
+            # Take out the keys of what the move changes, and put them back in afterwards
+            public_key = self.public_key ^ self._status_key()
+            if self.on_the_table:
+                public_key ^= card_set_key(self.on_the_table[-1], TOP_KEYS)
+
+        # If the move is PASS then the current trick is over
+        if move == PASS:
             # Trick over so update the game state
-            self.discards.extend([a for b in self.on_the_table for a in b])
+            if hashing:
+                public_key ^= card_set_key(self.played_cards & ~self.discards, TABLE_TO_DISCARD_KEYS)
+            for played in self.on_the_table:
+                self.discards |= played
             self.on_the_table = []
             self.straight_length = 0
             self.consecutive_mode = 0
             self.combo_size = 0
             self.player_to_move = self.get_next_player(self.player_to_move)
         else:
-            if len(move) > 1:
-                # The player put down multiple cards - add modes
-                if move[0].rank == move[1].rank:
-                    self.combo_size = len(move)
-                else:
-                    self.straight_length = len(move)
+            cards = move_cards(move)
+            kind = move_kind(move)
+            # If the player put down multiple cards - add modes
+            if kind == MOVE_COMBO:
+                self.combo_size = popcount(cards)
+            elif kind == MOVE_STRAIGHT:
+                self.straight_length = popcount(cards)
 
             # On the second move, check for CONSECUTIVE mode
             if len(self.on_the_table) == 1:
-                # Check the highest card (TODO assume they are ordered) on the first hand.
-                if self.on_the_table[0][-1].rank + 1 == move[0].rank:
+                # Compare the highest card on the first hand with the lowest card played.
+                if index_rank(highest_index(self.on_the_table[0])) + 1 == \
+                        index_rank(lowest_index(cards)):
                     self.consecutive_mode = 1
 
-            # Store the played card in the current trick
-            self.on_the_table.append(move)
+            # Store the played cards in the current trick
+            self.on_the_table.append(cards)
+            self.played_cards |= cards
 
-            # Remove the card from the player's hand
-            # TODO - this is probably slow
-            for card in move:
-                self.player_hands[self.player_to_move].remove(card)
+            # Remove the cards from the player's hand
+            hand = self.player_hands[player]
+            self.player_hands[player] = hand & ~cards
+            if hashing:
+                self.hand_keys[player] ^= card_set_key(cards, HAND_KEYS[player])
+                size = popcount(hand)
+                public_key ^= card_set_key(cards, PLAY_KEYS) ^ \
+                    HAND_SIZE_KEYS[player][size] ^ HAND_SIZE_KEYS[player][size - popcount(cards)]
 
             if self.player_hands[self.player_to_move]:
                 # Only change players if the current player didn't just finish
@@ -150,88 +342,199 @@ class PresidentGameState(GameState):
                 # moves for that player to signal the end of hte game
                 self.player_to_move = self.get_next_player(self.player_to_move)
 
+        if hashing:
+            self.public_key = public_key ^ self._status_key()
+        return token
+
+    def undo_move(self, token):
+        """ Undo the move that do_move returned token for.
+        """
+        self.invalidate_moves()
+        (player, hand, self.discards, self.played_cards, table, self.combo_size,
+         self.consecutive_mode, self.straight_length, hand_key, self.public_key) = token
+        if table is None:
+            # The move put cards on the table
+            self.on_the_table.pop()
+        else:
+            # The move was PASS, which cleared the table
+            self.on_the_table = table
+        self.player_hands[player] = hand
+        self.hand_keys[player] = hand_key
+        self.player_to_move = player
+
+    def _candidate_cards(self, hand):
+        """
+        Return the card set of the cards in hand that could be part of a move.
+        """
+        if not self.on_the_table:
+            # May lead a trick with any card. Can't pass - that would be silly.
+            return hand
+
+        # Start by picking out just the higher cards. Card rank needs to be strictly greater.
+        # Grab the rank of the highest card from the last play.
+        shift = (index_rank(highest_index(self.on_the_table[-1])) + 1 - 2) * 4
+
+        if self.consecutive_mode:
+            if self.straight_length > 0:
+                # This is a straight - therefore we have a min and max range
+                return ((hand >> shift) & ((1 << 4 * self.straight_length) - 1)) << shift
+            else:
+                # Not a straight - therefore an exact rank is required
+                return ((hand >> shift) & 0xF) << shift
+        return (hand >> shift) << shift
+
     def get_moves(self):
         """
         Get all possible moves from this state.
-        """
 
-        hand = sorted(self.player_hands[self.player_to_move],
-                                        key=attrgetter('rank', 'suit'))
+        The hand is a card set, which doubles as a histogram of the hand: each
+        rank's suits are held in one nibble, so the combos of a rank can be
+        looked up from COMBO_SUITS, and (because the same suit of the next rank
+        is four bits higher) shifting the hand by four and ANDing it with itself
+        finds the start of every same-suit run at once.
+        """
+        hand = self.player_hands[self.player_to_move]
         if not hand:
             # If there are no moves left, then return the empty list.
-            return hand
+            return []
+
+        leading = not self.on_the_table
+        candidates = self._candidate_cards(hand)
+
+        moves = []
+        if self.combo_size == 0 and self.straight_length == 0:
+            # Always include the single cards when not in combo mode
+            for index in card_indexes(candidates):
+                moves.append(SINGLE_MOVES[index])
+
+        if leading or (self.combo_size > 0 and self.straight_length == 0):
+            # Find the DUBS, TRIPS and QUADS, one rank at a time
+            if leading:
+                combos = LEAD_COMBO_SUITS
+            else:
+                combos = COMBO_SUITS[self.combo_size]
+            remaining = candidates
+            while remaining:
+                shift = lowest_index(remaining) & ~3
+                suits = (remaining >> shift) & 0xF
+                remaining ^= suits << shift
+                for combo in combos[suits]:
+                    moves.append(COMBO_TAG | (combo << shift))
+
+        if leading or self.straight_length > 0:
+            # Find the RUNS. A bit is set in starts if a run of the current
+            # length starts at that card.
+            if leading:
+                length = 3
+            else:
+                length = self.straight_length
+            starts = run_starts(candidates, length)
+            while starts:
+                span = STRAIGHT_SPANS[length]
+                for index in card_indexes(starts):
+                    moves.append(STRAIGHT_TAG | (span << index))
+                if not leading:
+                    break
+                # Extend the runs found so far by one card
+                starts &= candidates >> (4 * length)
+                length += 1
+
+        # Can always pass.
+        moves.append(PASS)
+        return moves
+
+    def get_random_move(self, rng):
+        """
+        Return a random legal move without building the list of moves.
+        Every move in get_moves() is equally likely, so rollouts follow the same
+        distribution as choosing uniformly from get_moves(). Instead of building
+        every move, the moves of each kind are counted (singles and runs by
+        popcount, combos from COMBO_SUITS), and only the chosen one is built.
+        """
+        hand = self.player_hands[self.player_to_move]
+        if not hand:
+            return None
+        leading = not self.on_the_table
+        candidates = self._candidate_cards(hand)
+
+        if self.combo_size == 0 and self.straight_length == 0:
+            singles = candidates
+            if not leading:
+                # The common case - a single card or PASS
+                num_singles = popcount(singles)
+                choice = rng.randrange(num_singles + 1)
+                if choice == num_singles:
+                    return PASS
+                return SINGLE_MOVES[card_indexes(singles)[choice]]
         else:
-            if not self.on_the_table:
-                # May lead a trick with any card. Can't pass - that would be silly.
-                # Moves may involve multiple cards, so return a list of lists.
-                candidate_cards = hand
+            singles = 0
+        num_singles = popcount(singles)
+
+        # Count the combos of each rank
+        combo_ranks = []
+        num_combos = 0
+        if leading or (self.combo_size > 0 and self.straight_length == 0):
+            if leading:
+                combos = LEAD_COMBO_SUITS
             else:
-                # Start by picking out just the higher cards. Card rank needs to be strictly greater.
-                # Grab the rank of the last card from the last trick.
-                minimum_rank = self.on_the_table[-1][-1].rank + 1
-
-                if self.consecutive_mode:
-                    if self.straight_length > 0:
-                        # This is a straight - therefore we have a min and max range
-                        candidate_cards = [card for card in hand if card.rank >= minimum_rank and card.rank < minimum_rank + self.straight_length]
-                    else:
-                        # Not a straight - therefore an exact rank is required
-                        candidate_cards = [card for card in hand if card.rank == minimum_rank]
-                else:
-                    candidate_cards = [card for card in hand if card.rank >= minimum_rank]
-
-            moves = []
-            # TODO - alternative implementation for finding straights -
-            # Split the deck by suit, and only both search suits that have more than three cards.
-
-
-            for index, card in enumerate(candidate_cards):
-                # Make a single loop through the candidate cards and include
-                # not just the valid single card plays but also the DUBS, TRIPS, QUADS and RUNS.
-                straight_found = [card]
-
-                if self.combo_size == 0 and self.straight_length == 0:
-                    # Always include the single cards when not in combo mode
-                    moves.append([card])
-
-                if not self.on_the_table or self.combo_size > 0 or self.straight_length > 0:
-                    # It's either the first hand, or playing to a straight or combo. There's more work to do...
-                    # Now get the list of the higher cards
-                    next_cards = candidate_cards[index+1:]
-
-                    for next_cards_index, next_card in enumerate(next_cards):
-
-                        if not self.on_the_table or (self.combo_size > 0 and self.straight_length == 0):
-                            # Start looking ahead to find combos
-                            if card.rank == next_card.rank:
-                                if not self.on_the_table or self.combo_size == 2:
-                                    # A pair
-                                    moves.append([card, next_card])
-
-                                if not self.on_the_table or self.combo_size == 3:
-                                    # This is the second next_card - must be TRIPS
-                                    if next_cards_index == 1:
-                                        moves.append([card, next_cards[0], next_cards[1]])
-
-                                if not self.on_the_table or self.combo_size == 4:
-                                    # This is the third next_card - must be QUADS
-                                    if next_cards_index == 2:
-                                        moves.append([card, next_cards[0], next_cards[1], next_cards[2]])
-
-                        if not self.on_the_table or self.straight_length > 0:
-                            # Start looking ahead to find straights
-                            # Check the last card found in the run found so far. Add the card to the list if it's good.
-                            if straight_found[-1].rank + 1 == next_card.rank and straight_found[-1].suit == next_card.suit:
-                                straight_found.append(next_card)
-                                if not self.on_the_table and len(straight_found) >= 3:
-                                    # Opening move and the straight is at least three long. Record it.
-                                    moves.append(copy(straight_found))
-                                elif self.on_the_table and len(straight_found) == self.straight_length:
-                                    # A straight long enough to play on a previous straight has been found.
-                                    moves.append(straight_found)
-
-            # Can always pass.
-            return  moves + ["PASS"]
+                combos = COMBO_SUITS[self.combo_size]
+            remaining = candidates
+            while remaining:
+                shift = lowest_index(remaining) & ~3
+                suits = (remaining >> shift) & 0xF
+                remaining ^= suits << shift
+                if combos[suits]:
+                    combo_ranks.append((shift, combos[suits]))
+                    num_combos += len(combos[suits])
+
+        # Count the runs of each length
+        runs = []
+        num_runs = 0
+        if leading or self.straight_length > 0:
+            if leading:
+                length = 3
+            else:
+                length = self.straight_length
+            starts = run_starts(candidates, length)
+            while starts:
+                runs.append((length, starts))
+                num_runs += popcount(starts)
+                if not leading:
+                    break
+                starts &= candidates >> (4 * length)
+                length += 1
+
+        # Can always pass (as in get_moves, even when leading)
+        choice = rng.randrange(num_singles + num_combos + num_runs + 1)
+        if choice < num_singles:
+            return SINGLE_MOVES[card_indexes(singles)[choice]]
+        choice -= num_singles
+        for shift, rank_combos in combo_ranks:
+            if choice < len(rank_combos):
+                return COMBO_TAG | (rank_combos[choice] << shift)
+            choice -= len(rank_combos)
+        for length, starts in runs:
+            num_starts = popcount(starts)
+            if choice < num_starts:
+                return STRAIGHT_TAG | (STRAIGHT_SPANS[length] << card_indexes(starts)[choice])
+            choice -= num_starts
+        return PASS
+
+    def is_game_over(self):
+        """ Return whether the game has ended, i.e. the player to move has no cards.
+        """
+        return not self.player_hands[self.player_to_move]
+
+    def do_random_rollouts(self, states, rng, max_moves=None):
+        """
+        Play random games from every state in states to the end, or for at most
+        max_moves moves, as do_random_rollout would, and return the number of
+        moves played in each. With numpy the states are played together, in
+        lockstep, by batch_rollouts; rng only seeds the random numbers they use.
+        """
+        if numpy is None:
+            return GameState.do_random_rollouts(self, states, rng, max_moves)
+        return batch_rollouts(states, numpy.random.RandomState(rng.getrandbits(32)), max_moves)
 
     def get_result(self, player):
         """
@@ -240,36 +543,383 @@ class PresidentGameState(GameState):
         # If the play has nothing in their hand then they've won.
         return 1 if not self.player_hands[player] else 0
 
+    def evaluate(self, player):
+        """
+        Estimate the chance that player wins from the cards each player has
+        left, the ranks they hold (as a combo of a rank is played at once), how
+        many aces and twos they hold and who is to move.
+        """
+        mine = self.player_hands[player]
+        theirs = self.player_hands[1 - player]
+        if not mine or not theirs:
+            return self.get_result(player)
+        score = EVALUATION_WEIGHTS["cards"] * (popcount(theirs) - popcount(mine)) + \
+            EVALUATION_WEIGHTS["ranks"] * (ranks_held(theirs) - ranks_held(mine)) + \
+            EVALUATION_WEIGHTS["high_cards"] * (popcount(mine & HIGH_CARDS) - popcount(theirs & HIGH_CARDS)) + \
+            EVALUATION_WEIGHTS["to_move"] * (1 if self.player_to_move == player else -1)
+        return 1.0 / (1.0 + exp(-score))
+
+    def solve(self, max_size=None, memo=None):
+        """
+        If the two hands hold at most max_size cards between them (or max_size is
+        None), return {player: result} for the end of the game when both players
+        play perfectly, seeing each other's cards. See solve_endgame. Otherwise
+        return None.
+        """
+        if max_size is not None and \
+                popcount(self.player_hands[0]) + popcount(self.player_hands[1]) > max_size:
+            return None
+        win = solve_endgame(self, memo)
+        return {self.player_to_move: win, 1 - self.player_to_move: 1 - win}
+
     def __repr__(self):
         """ Return a human-readable representation of the state
         """
         result = "P%i: %s Consec: %s Combo: %s Straight: %s Trick: %s Discards: %s" % (
         self.player_to_move,
-        self.player_hands[self.player_to_move],
+        cards_in(self.player_hands[self.player_to_move]),
         # self.player_hands,
         self.consecutive_mode,
         self.combo_size,
         self.straight_length,
-        self.on_the_table,
-        self.discards)
+        [cards_in(played) for played in self.on_the_table],
+        cards_in(self.discards))
         return result
 
+def _popcounts(masks):
+    """ Return the number of cards in each card set of an int64 array.
+    """
+    return BYTE_POPCOUNTS[masks.view(numpy.uint8)].reshape(len(masks), 8).sum(axis=1)
+
+
+def _batch_random_moves(hands, leading, lowest, consecutive_mode, combo_size, straight_length,
+                        random_state):
+    """
+    Choose a random legal move for each of a batch of games, uniformly from the
+    moves that get_moves would return, as get_random_move does: the moves are
+    counted and then one of them, or PASS, is picked.
+    The arguments are arrays with an entry per game: the hand of the player to
+    move, whether they lead the trick, the lowest rank (as a nibble index) they
+    may play to it, and the modes of the trick.
+    Return arrays of the card sets, kinds (MOVE_SINGLE, MOVE_COMBO, MOVE_STRAIGHT
+    or MOVE_PASS), sizes and lowest and highest nibbles of the moves.
+    """
+    num_games = len(hands)
+    rows = numpy.arange(num_games)
+    lowest = numpy.where(leading, 0, lowest)
+    consecutive_mode = consecutive_mode & ~leading
+
+    # Count the singles and combos of each rank that may be played
+    nibbles = (hands[:, None] >> NIBBLE_SHIFTS) & 0xF
+    move_row = numpy.where(leading, 0, numpy.where(straight_length > 0, 5,
+                                                   numpy.maximum(combo_size, 1)))
+    ranks = numpy.where(consecutive_mode[:, None], NIBBLES == lowest[:, None],
+                        NIBBLES >= lowest[:, None])
+    rank_counts = NIBBLE_MOVE_COUNTS[move_row[:, None], nibbles] * ranks
+    num_rank_moves = rank_counts.sum(axis=1)
+
+    # Count the runs of each length that may be played, from 3 cards up, by the
+    # cards they start at (as in run_starts)
+    first_cards = numpy.where(consecutive_mode, 0xF << (4 * lowest), -1 << (4 * lowest))
+    runs = hands & (hands >> 4)
+    starts_by_length = []
+    length = 2
+    while length < 13 and runs.any():
+        length += 1
+        runs &= hands >> (4 * (length - 1))
+        starts_by_length.append(runs & first_cards &
+                                numpy.where(leading | (straight_length == length), -1, 0))
+    starts_by_length = numpy.array(starts_by_length).reshape(-1, num_games)
+    straight_counts = numpy.array([_popcounts(starts) for starts in starts_by_length]).reshape(
+        -1, num_games).T
+    num_straights = straight_counts.sum(axis=1)
+
+    # Choose a move, and build it. The moves not chosen from either are PASS.
+    choice = (random_state.random_sample(num_games) *
+              (num_rank_moves + num_straights + 1)).astype(numpy.int64)
+    cards = numpy.zeros(num_games, dtype=numpy.int64)
+    kinds = numpy.full(num_games, MOVE_PASS, dtype=numpy.int64)
+    sizes = numpy.zeros(num_games, dtype=numpy.int64)
+    low = numpy.zeros(num_games, dtype=numpy.int64)
+    high = numpy.zeros(num_games, dtype=numpy.int64)
+
+    chosen = rows[choice < num_rank_moves]
+    if len(chosen):
+        counts = rank_counts[chosen]
+        cumulative = counts.cumsum(axis=1)
+        nibble = (cumulative > choice[chosen, None]).argmax(axis=1)
+        picked = numpy.arange(len(chosen))
+        index = choice[chosen] - cumulative[picked, nibble] + counts[picked, nibble]
+        suits = NIBBLE_MOVE_SUITS[move_row[chosen], nibbles[chosen, nibble], index]
+        cards[chosen] = suits << (4 * nibble)
+        sizes[chosen] = BYTE_POPCOUNTS[suits]
+        kinds[chosen] = numpy.where(sizes[chosen] == 1, MOVE_SINGLE, MOVE_COMBO)
+        low[chosen] = nibble
+        high[chosen] = nibble
+
+    choice -= num_rank_moves
+    chosen = rows[(choice >= 0) & (choice < num_straights)]
+    if len(chosen):
+        counts = straight_counts[chosen]
+        cumulative = counts.cumsum(axis=1)
+        i = (cumulative > choice[chosen, None]).argmax(axis=1)
+        picked = numpy.arange(len(chosen))
+        index = choice[chosen] - cumulative[picked, i] + counts[picked, i]
+        # Find the index'th card that starts a run of the chosen length
+        starts = starts_by_length[i, chosen]
+        start = (((starts[:, None] >> BIT_SHIFTS) & 1).cumsum(axis=1) > index[:, None]).argmax(axis=1)
+        length = i + 3
+        cards[chosen] = STRAIGHT_SPAN_MASKS[length] << start
+        kinds[chosen] = MOVE_STRAIGHT
+        sizes[chosen] = length
+        low[chosen] = start >> 2
+        high[chosen] = (start >> 2) + length - 1
+    return cards, kinds, sizes, low, high
+
+
+def batch_rollouts(states, random_state, max_moves=None):
+    """
+    Play random games to the end, or for at most max_moves moves, from a list of
+    states, all at once with numpy arrays, and return the number of moves played
+    in each. random_state is the numpy.random.RandomState to use.
+    Every step plays a move in each game still going, chosen by
+    _batch_random_moves as get_random_move would choose it, so the results are
+    distributed as with do_random_rollout, but the random numbers differ.
+    """
+    num_games = len(states)
+    games = numpy.arange(num_games)
+    hands = numpy.array([state.player_hands for state in states], dtype=numpy.int64)
+    discards = numpy.array([state.discards for state in states], dtype=numpy.int64)
+    played_cards = numpy.array([state.played_cards for state in states], dtype=numpy.int64)
+    # The plays on the table of each game, in order, their union and the nibble
+    # of the highest card of the last one
+    plays = numpy.zeros((num_games, 35), dtype=numpy.int64)
+    table_length = numpy.array([len(state.on_the_table) for state in states])
+    table = numpy.zeros(num_games, dtype=numpy.int64)
+    top = numpy.zeros(num_games, dtype=numpy.int64)
+    for (g, state) in enumerate(states):
+        plays[g, :len(state.on_the_table)] = state.on_the_table
+        table[g] = state.played_cards & ~state.discards
+        if state.on_the_table:
+            top[g] = highest_index(state.on_the_table[-1]) >> 2
+    combo_size = numpy.array([state.combo_size for state in states])
+    straight_length = numpy.array([state.straight_length for state in states])
+    consecutive_mode = numpy.array([state.consecutive_mode for state in states], dtype=bool)
+    to_move = numpy.array([state.player_to_move for state in states])
+    num_moves = numpy.zeros(num_games, dtype=numpy.int64)
+
+    # The games still being played
+    active = games[hands[games, to_move] != 0]
+    while len(active):
+        mover = to_move[active]
+        (cards, kinds, sizes, low, high) = _batch_random_moves(
+            hands[active, mover], table_length[active] == 0, top[active] + 1,
+            consecutive_mode[active], combo_size[active], straight_length[active], random_state)
+        num_moves[active] += 1
+
+        # PASS ends the trick
+        passing = kinds == MOVE_PASS
+        done = active[passing]
+        discards[done] |= table[done]
+        table[done] = 0
+        table_length[done] = 0
+        combo_size[done] = 0
+        straight_length[done] = 0
+        consecutive_mode[done] = False
+        to_move[done] ^= 1
+
+        # Anything else is played to the table
+        playing = ~passing
+        done = active[playing]
+        (mover, cards, kinds, sizes, low, high) = (
+            mover[playing], cards[playing], kinds[playing], sizes[playing], low[playing], high[playing])
+        combo_size[done] = numpy.where(kinds == MOVE_COMBO, sizes, combo_size[done])
+        straight_length[done] = numpy.where(kinds == MOVE_STRAIGHT, sizes, straight_length[done])
+        # On the second play, check for consecutive mode
+        consecutive_mode[done] |= (table_length[done] == 1) & (top[done] + 1 == low)
+        plays[done, table_length[done]] = cards
+        table_length[done] += 1
+        table[done] |= cards
+        top[done] = high
+        played_cards[done] |= cards
+        hands[done, mover] &= ~cards
+        # Only change players if the player didn't just finish
+        to_move[done] ^= hands[done, mover] != 0
+
+        active = active[hands[active, to_move[active]] != 0]
+        if max_moves is not None:
+            active = active[num_moves[active] < max_moves]
+
+    for (g, state) in enumerate(states):
+        state.player_hands = [int(hands[g, 0]), int(hands[g, 1])]
+        state.discards = int(discards[g])
+        state.on_the_table = [int(play) for play in plays[g, :table_length[g]]]
+        state.played_cards = int(played_cards[g])
+        state.combo_size = int(combo_size[g])
+        state.straight_length = int(straight_length[g])
+        state.consecutive_mode = int(consecutive_mode[g])
+        state.player_to_move = int(to_move[g])
+        state.invalidate_moves()
+        if state.hashing:
+            state.rehash()
+    return [int(moves) for moves in num_moves]
+
+
+def solve_endgame(state, memo=None):
+    """
+    Return 1 if the player to move wins with perfect play by both players, who
+    can see all the cards, or 0 if they lose. This is an alpha-beta search with
+    the window (0, 1), which stops at the first winning move, trying the moves
+    that play the most cards first.
+    memo is a dictionary of the positions solved so far, which may be shared by
+    calls for states of the same game. Positions are keyed on what the moves
+    from them depend on: the hands, the last play on the table, whether it is
+    the first play of the trick, and the modes.
+    PASS is never tried when leading, as it only hands the lead over, and the
+    other player could hand it back. Nor can it win: it can only help if every
+    lead of the other player loses, and then they would pass too.
+    """
+    if memo is None:
+        memo = {}
+    state = state.clone()
+    # Nothing looks at the keys of the positions searched
+    state.hashing = False
+    return _solve(state, memo)
+
+
+def _solve(state, memo):
+    """ The search of solve_endgame, which plays and undoes its moves in state.
+    """
+    player = state.player_to_move
+    hands = state.player_hands
+    if not hands[player]:
+        # The player who finishes stays to move
+        return 1
+    table = state.on_the_table
+    key = (hands[player], hands[1 - player], table[-1] if table else 0, len(table) == 1,
+           state.combo_size, state.straight_length, state.consecutive_mode)
+    value = memo.get(key)
+    if value is not None:
+        return value
+
+    value = 0
+    moves = state.get_legal_moves()
+    if not table:
+        moves = moves[:-1]  # PASS is always the last move
+    for move in sorted(moves, key=lambda m: -popcount(move_cards(m))):
+        token = state.do_move(move)
+        win = state.player_to_move == player or not _solve(state, memo)
+        state.undo_move(token)
+        if win:
+            value = 1
+            break
+    memo[key] = value
+    return value
+
+
+def reference_moves(state):
+    """
+    The original list-scanning implementation of PresidentGameState.get_moves,
+    kept so that test_move_generator can check the faster generator against it.
+    Returns lists of cards, and "PASS", rather than encoded moves.
+    """
+    hand = cards_in(state.player_hands[state.player_to_move])
+    if not hand:
+        # If there are no moves left, then return the empty list.
+        return hand
+    else:
+        if not state.on_the_table:
+            # May lead a trick with any card. Can't pass - that would be silly.
+            # Moves may involve multiple cards, so return a list of lists.
+            candidate_cards = hand
+        else:
+            # Start by picking out just the higher cards. Card rank needs to be strictly greater.
+            # Grab the rank of the last card from the last trick.
+            minimum_rank = index_rank(highest_index(state.on_the_table[-1])) + 1
+
+            if state.consecutive_mode:
+                if state.straight_length > 0:
+                    # This is a straight - therefore we have a min and max range
+                    candidate_cards = [card for card in hand if card.rank >= minimum_rank and card.rank < minimum_rank + state.straight_length]
+                else:
+                    # Not a straight - therefore an exact rank is required
+                    candidate_cards = [card for card in hand if card.rank == minimum_rank]
+            else:
+                candidate_cards = [card for card in hand if card.rank >= minimum_rank]
+
+        moves = []
+        # TODO - alternative implementation for finding straights -
+        # Split the deck by suit, and only both search suits that have more than three cards.
+
+
+        for index, card in enumerate(candidate_cards):
+            # Make a single loop through the candidate cards and include
+            # not just the valid single card plays but also the DUBS, TRIPS, QUADS and RUNS.
+            straight_found = [card]
+
+            if state.combo_size == 0 and state.straight_length == 0:
+                # Always include the single cards when not in combo mode
+                moves.append([card])
+
+            if not state.on_the_table or state.combo_size > 0 or state.straight_length > 0:
+                # It's either the first hand, or playing to a straight or combo. There's more work to do...
+                # Now get the list of the higher cards
+                next_cards = candidate_cards[index+1:]
+
+                for next_cards_index, next_card in enumerate(next_cards):
+
+                    if not state.on_the_table or (state.combo_size > 0 and state.straight_length == 0):
+                        # Start looking ahead to find combos
+                        if card.rank == next_card.rank:
+                            if not state.on_the_table or state.combo_size == 2:
+                                # A pair
+                                moves.append([card, next_card])
+
+                            if not state.on_the_table or state.combo_size == 3:
+                                # This is the second next_card - must be TRIPS
+                                if next_cards_index == 1:
+                                    moves.append([card, next_cards[0], next_cards[1]])
+
+                            if not state.on_the_table or state.combo_size == 4:
+                                # This is the third next_card - must be QUADS
+                                if next_cards_index == 2:
+                                    moves.append([card, next_cards[0], next_cards[1], next_cards[2]])
+
+                    if not state.on_the_table or state.straight_length > 0:
+                        # Start looking ahead to find straights
+                        # Check the last card found in the run found so far. Add the card to the list if it's good.
+                        if straight_found[-1].rank + 1 == next_card.rank and straight_found[-1].suit == next_card.suit:
+                            straight_found.append(next_card)
+                            if not state.on_the_table and len(straight_found) >= 3:
+                                # Opening move and the straight is at least three long. Record it.
+                                moves.append(copy(straight_found))
+                            elif state.on_the_table and len(straight_found) == state.straight_length:
+                                # A straight long enough to play on a previous straight has been found.
+                                moves.append(copy(straight_found))
+
+        # Can always pass.
+        return  moves + ["PASS"]
+
 
 def play_self():
     """ Play a sample game between two ismcts players.
     """
     state = PresidentGameState()
     state._deal()
+    # Each player keeps its own search tree from move to move
+    sessions = [SearchSession(), SearchSession()]
 
-    while state.get_moves():
+    while state.get_legal_moves():
         print str(state)
         # Use different numbers of iterations (simulations, tree nodes) for different players
         if state.player_to_move == 0:
-            m = ismcts(rootstate=state, itermax=1000, verbose=False)
+            m = sessions[0].search(rootstate=state, itermax=1000, verbose=False).move
         else:
-            m = ismcts(rootstate=state, itermax=100, verbose=False)
-        print "Best Move: " + str(m) + "\n"
+            m = sessions[1].search(rootstate=state, itermax=100, verbose=False).move
+        print "Best Move: " + move_to_string(m) + "\n"
         state.do_move(m)
+        for session in sessions:
+            session.advance(m)
 
     for p in (0,1):
         if state.get_result(p) > 0:
@@ -320,7 +970,7 @@ def play_game():
     #                          Card('KS'),
     #                          Card('AD'),
     #                          Card('2D')]
-    state.player_hands[0] = [
+    state.player_hands[0] = card_set([
                          Card('9d'),
                          Card('js'),
                          Card('qc'),
@@ -337,63 +987,249 @@ def play_game():
                          Card('4d'),
                          Card('qs'),
                          Card('tc'),
-                         Card('7s')]
+                         Card('7s')])
 
 
     TOTAL_CARDS = 17
-    while len(state.player_hands[0]) < TOTAL_CARDS:
-        card = get_card("Enter card %s/%s: " % (len(state.player_hands[0]) + 1, TOTAL_CARDS))
-        if card not in state.player_hands[0]:
-            state.player_hands[0].append(card)
+    while popcount(state.player_hands[0]) < TOTAL_CARDS:
+        card = get_card("Enter card %s/%s: " % (popcount(state.player_hands[0]) + 1, TOTAL_CARDS))
+        if not state.player_hands[0] & card_bit(card):
+            state.player_hands[0] |= card_bit(card)
         else:
             print "Duplicate card - ignoring"
 
     print "All done"
-    print state.player_hands[0]
+    print cards_in(state.player_hands[0])
+    state.rehash()
+
+    # Keep the search tree from move to move, following the moves of both players
+    session = SearchSession()
 
     while True:
         print str(state)
         # Use different numbers of iterations (simulations, tree nodes) for different players
         if state.player_to_move == 0:
-            m = ismcts(rootstate=state, itermax=10000, verbose=False)
-            print "Best Move: " + str(m) + "\n"
+            m = session.search(rootstate=state, itermax=10000, verbose=False).move
+            print "Best Move: " + move_to_string(m) + "\n"
             state.do_move(m)
+            session.advance(m)
             if not state.player_hands[0]:
                 # No cards left - the end
                 break
 
         else:
             confirmed_move = False
-            move = []
+            move = PASS
             while not confirmed_move:
                 num_cards = get_int("How many cards did the other player play?")
-                move = []
-                if num_cards == 0:
-                    move = "PASS"
-                else:
-                    for i in range(num_cards):
-                        card = get_card("What was the card?")
-                        move.append(card)
+                cards = []
+                for i in range(num_cards):
+                    card = get_card("What was the card?")
+                    cards.append(card)
+                move = cards_to_move(cards)
 
-
-                user_input = raw_input("Did the player play this (y/n)? %s" % move)
+                user_input = raw_input("Did the player play this (y/n)? %s" % move_to_string(move))
                 if user_input is "y" or user_input is "Y":
                     confirmed_move = True
                 else:
                     print "Let's try again..."
 
-            if move is not "PASS":
-                state.player_hands[1].extend(move)
+            if move != PASS:
+                state.player_hands[1] |= move_cards(move)
+                state.rehash()
             state.do_move(move)
-            
-            if move is not "PASS":
+            session.advance(move)
+
+            if move != PASS:
                 state.player_to_move = state.get_next_player(state.player_to_move)
+                state.invalidate_moves()
+                state.rehash()
 
     for p in (0,1):
         if state.get_result(p) > 0:
             print "Player " + str(p) + " wins!"
 
 
+def test_move_generator(num_games=1000):
+    """
+    Check that get_moves generates the same moves as reference_moves in every
+    state of num_games random games.
+    """
+    for game_num in range(num_games):
+        state = PresidentGameState()
+        state._deal()
+        while True:
+            moves = state.get_moves()
+            expected = [PASS if move == "PASS" else cards_to_move(move)
+                        for move in reference_moves(state)]
+            assert len(moves) == len(expected), state
+            assert set(moves) == set(expected), state
+            if not moves:
+                break
+            state.do_move(random.choice(moves))
+    print "get_moves matches reference_moves in %s games" % num_games
+
+
+def test_undo_move(num_games=200):
+    """
+    Check that undo_move returns the state to what it was before do_move, for
+    every move of num_games random games, and that undoing a whole game returns
+    it to the deal.
+    """
+    for game_num in range(num_games):
+        state = PresidentGameState()
+        state._deal()
+        dealt = state_fields(state)
+        tokens = []
+        while state.get_legal_moves():
+            before = state_fields(state)
+            move = random.choice(state.get_legal_moves())
+            state.undo_move(state.do_move(move))
+            assert state_fields(state) == before, (state, move_to_string(move))
+            assert set(state.get_legal_moves()) == set(state.get_moves()), state
+            # Redo the move and carry on
+            tokens.append(state.do_move(move))
+        while tokens:
+            state.undo_move(tokens.pop())
+        assert state_fields(state) == dealt, state
+    print "undo_move reverses do_move in %s games" % num_games
+
+
+def test_zobrist_keys(num_games=200):
+    """
+    Check that the Zobrist keys that do_move and undo_move keep up to date equal
+    the keys computed from scratch by rehash, and that randomizing the hidden
+    cards leaves the observer's information_set_key alone, in every state of
+    num_games random games.
+    """
+    def check_keys(state):
+        fresh = state.clone()
+        fresh.rehash()
+        assert state.zobrist_key() == fresh.zobrist_key(), state
+        for p in (0, 1):
+            assert state.information_set_key(p) == fresh.information_set_key(p), state
+            assert state.clone_and_randomize(p).information_set_key(p) == \
+                state.information_set_key(p), state
+
+    for game_num in range(num_games):
+        state = PresidentGameState()
+        state._deal()
+        check_keys(state)
+        while state.get_legal_moves():
+            move = random.choice(state.get_legal_moves())
+            state.undo_move(state.do_move(move))
+            check_keys(state)
+            state.do_move(move)
+            check_keys(state)
+    print "Zobrist keys match rehash in %s games" % num_games
+
+
+def test_batch_rollouts(num_games=50, num_positions=10, num_rollouts=1000):
+    """
+    Check batch_rollouts against the scalar rollouts. In every state of num_games
+    random games, a batched step must leave each game as do_move would leave it
+    after one of its legal moves. From num_positions positions, the win rate of
+    the player to move and the mean number of moves of num_rollouts batched
+    rollouts must be within four standard errors of those of as many
+    do_random_rollout calls.
+    """
+    random_state = numpy.random.RandomState(0)
+    for game_num in range(num_games):
+        state = PresidentGameState()
+        state._deal()
+        while state.get_legal_moves():
+            expected = []
+            for move in state.get_legal_moves():
+                child = state.clone()
+                child.do_move(move)
+                expected.append(state_fields(child))
+            batch = [state.clone() for i in range(8)]
+            assert batch_rollouts(batch, random_state, 1) == [1] * len(batch), state
+            for child in batch:
+                assert state_fields(child) in expected, (state, child)
+            state.do_move(random.choice(state.get_legal_moves()))
+
+    positions = []
+    while len(positions) < num_positions:
+        state = PresidentGameState()
+        state._deal()
+        state.do_random_rollout(random, max_moves=random.randrange(40))
+        if state.get_legal_moves():
+            positions.append(state)
+    for state in positions:
+        player = state.player_to_move
+        scalar = [state.clone() for i in range(num_rollouts)]
+        scalar_moves = [child.do_random_rollout(random) for child in scalar]
+        batch = [state.clone() for i in range(num_rollouts)]
+        batch_moves = batch_rollouts(batch, random_state)
+        for child in batch:
+            assert child.is_game_over(), child
+        for (scalar_values, batch_values) in (
+                ([child.get_result(player) for child in scalar], [child.get_result(player) for child in batch]),
+                (scalar_moves, batch_moves)):
+            scalar_values = numpy.array(scalar_values, dtype=float)
+            batch_values = numpy.array(batch_values, dtype=float)
+            error = sqrt((scalar_values.var() + batch_values.var()) / num_rollouts)
+            assert abs(scalar_values.mean() - batch_values.mean()) <= 4 * error + 1e-9, state
+    print "batch_rollouts matches do_random_rollout in %s games and %s positions" % (
+        num_games, num_positions)
+
+
+def test_transposition_subtree(num_games=10, itermax=300):
+    """
+    Check that re-rooting a TranspositionTree through SearchSession.advance keeps
+    the graph acyclic and node_count equal to the number of nodes that can be
+    reached from the root, in num_games games between two sessions.
+    """
+    for game_num in range(num_games):
+        state = PresidentGameState()
+        state._deal()
+        sessions = [SearchSession(TranspositionTree()) for p in (0, 1)]
+        while state.get_legal_moves():
+            move = sessions[state.player_to_move].search(state, itermax, quiet=True).move
+            state.do_move(move)
+            for session in sessions:
+                session.advance(move)
+                tree = session.tree
+                # Walk the graph depth first, looking for an edge back into the path
+                on_path = set()
+                done = set()
+                stack = [(tree.root, False)]
+                while stack:
+                    node, leaving = stack.pop()
+                    if leaving:
+                        on_path.discard(id(node))
+                        done.add(id(node))
+                        continue
+                    if id(node) in done:
+                        continue
+                    assert id(node) not in on_path, "cycle in %s" % tree
+                    on_path.add(id(node))
+                    stack.append((node, True))
+                    for child in node.child_nodes.itervalues():
+                        assert id(child) not in on_path, "cycle in %s" % tree
+                        stack.append((child, False))
+                assert tree.node_count == len(done), tree
+    print "Re-rooted TranspositionTrees are acyclic and counted in %s games" % num_games
+
+
+def test_node_budget_errors():
+    """
+    Check that a search of a TranspositionTree, which can't be pruned, fails
+    with the same error for a max_nodes and a max_bytes budget.
+    """
+    state = PresidentGameState()
+    state._deal()
+    for budget in ({"max_nodes": 1000}, {"max_bytes": 1 << 20}):
+        try:
+            ismcts(state, 10, quiet=True, tree=TranspositionTree(), **budget)
+        except Exception as e:
+            assert str(e) == "TranspositionTree can't be pruned to a node budget", e
+        else:
+            assert False, "%s didn't fail" % budget
+    print "Node budgets fail on a TranspositionTree"
+
+
 def test_iters():
     # I want to know how many iteractions are good.
     # I'll play a player that does only 10 iterations, then keep pushing mine up to see how many wins/losses
@@ -412,7 +1248,7 @@ def test_iters():
                 print("(%s) Game number %s/%s" % (iterations, game_num, NUM_GAMES)),
                 sys.stdout.flush()
 
-            while state.get_moves():
+            while state.get_legal_moves():
                 # Use different numbers of iterations (simulations, tree nodes) for different players
                 if state.player_to_move == 0:
                     m = ismcts(rootstate=state, itermax=iterations, verbose=False, quiet=True)
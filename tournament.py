@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# Play matches between two ismcts configurations, in parallel, and decide which is
+# stronger with a sequential probability ratio test. For example:
+#
+#   python tournament.py --game president --a itermax=1000 --b itermax=100
+from math import log, sqrt
+import argparse
+import multiprocessing
+import random
+import sys
+
+from framework import SearchSession, NodeTree, ArrayTree, TranspositionTree
+from knockout_whist import KnockoutWhistState
+from president import PresidentGameState
+
+
+def new_game(game, players):
+    """ Return a new, dealt, state of the named game ("president" or "whist").
+    """
+    if game == "president":
+        state = PresidentGameState()
+        state._deal()
+        return state
+    if game == "whist":
+        return KnockoutWhistState(players)
+    raise Exception("Unknown game %s" % game)
+
+
+def game_players(game, players):
+    """ Return the player numbers of the named game, in seat order.
+    """
+    if game == "president":
+        return [0, 1]
+    return range(1, players + 1)
+
+
+# The trees that a configuration can ask for with "tree"
+TREES = {"node": NodeTree, "array": ArrayTree, "transposition": TranspositionTree}
+
+
+def new_session(config):
+    """ Return a SearchSession for a configuration, and the search arguments left over.
+    """
+    config = dict(config)
+    tree = TREES[config.pop("tree", "node")]()
+    session = SearchSession(tree, exploration=config.pop("exploration", 0.7))
+    return session, config
+
+
+def play_game(args):
+    """ Play one game of a tournament, in a worker process, and return
+        (deal number, seat, result) where result is the get_result() of the
+        seat that config_a played.
+        The deal is made from deal_seed so that every seat can be given the same
+        cards; only the first deal of a game of Knockout Whist is repeated, as
+        later rounds are dealt while playing.
+    """
+    game, players, deal_number, seat, deal_seed, search_seed, config_a, config_b = args
+    random.seed(deal_seed)
+    state = new_game(game, players)
+    random.seed(search_seed)
+
+    seats = game_players(game, players)
+    configs = dict((player, config_a if player == seats[seat] else config_b)
+                   for player in seats)
+    # Each player keeps its own search tree from move to move
+    sessions = dict((player, new_session(configs[player])) for player in seats)
+    while state.get_legal_moves():
+        session, config = sessions[state.player_to_move]
+        m = session.search(rootstate=state, quiet=True, **config).move
+        state.do_move(m)
+        for session, config in sessions.itervalues():
+            session.advance(m)
+    return deal_number, seat, state.get_result(seats[seat])
+
+
+def wilson_interval(wins, games, z=1.96):
+    """ Return the Wilson score interval (low, high) for a win rate of wins out of
+        games, by default at 95% confidence.
+    """
+    if not games:
+        return 0.0, 1.0
+    p = wins / float(games)
+    denominator = 1 + z * z / games
+    centre = (p + z * z / (2 * games)) / denominator
+    margin = z * sqrt(p * (1 - p) / games + z * z / (4 * games * games)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+class SPRT:
+    """
+    A sequential probability ratio test of whether config_a wins games at the
+    rate p0 (no stronger than config_b) or at the rate p1 (stronger), with false
+    positive rate alpha and false negative rate beta.
+    """
+
+    def __init__(self, p0, p1, alpha=0.05, beta=0.05):
+        if not 0 < p0 < p1 < 1:
+            raise Exception("SPRT needs 0 < p0 < p1 < 1, not p0=%s p1=%s" % (p0, p1))
+        self.p0 = p0
+        self.p1 = p1
+        self.lower = log(beta / (1 - alpha))
+        self.upper = log((1 - beta) / alpha)
+        self.win_llr = log(p1 / p0)
+        self.loss_llr = log((1 - p1) / (1 - p0))
+
+    def llr(self, wins, losses):
+        """ Return the log likelihood ratio of p1 against p0.
+        """
+        return wins * self.win_llr + losses * self.loss_llr
+
+    def decision(self, wins, losses):
+        """ Return "H1" if config_a is stronger, "H0" if it isn't, or None if
+            more games are needed to decide.
+        """
+        llr = self.llr(wins, losses)
+        if llr >= self.upper:
+            return "H1"
+        if llr <= self.lower:
+            return "H0"
+        return None
+
+
+class TournamentResult:
+    """
+    The outcome of a tournament, from the point of view of config_a.
+    """
+
+    def __init__(self, wins, games, sprt, decision):
+        self.wins = wins
+        self.games = games
+        self.win_rate = wins / float(games) if games else 0.0
+        self.interval = wilson_interval(wins, games)
+        self.llr = sprt.llr(wins, games - wins)
+        self.decision = decision
+
+    def __repr__(self):
+        return "[Games: %i Wins: %i Win rate: %.3f (95%% CI %.3f-%.3f) LLR: %.2f SPRT: %s]" % (
+            self.games, self.wins, self.win_rate, self.interval[0], self.interval[1],
+            self.llr, self.decision or "undecided")
+
+
+def tournament(config_a, config_b, game="president", players=2, max_games=1000,
+               workers=None, seed=0, delta=0.05, alpha=0.05, beta=0.05, quiet=False):
+    """
+    Play up to max_games games between config_a and config_b, which are
+    dictionaries of SearchSession.search arguments (e.g. {"itermax": 1000}) plus
+    optionally "exploration" and "tree" (one of TREES), and return a TournamentResult.
+    Every deal is played once with config_a in each seat, and config_b in the
+    others, so each configuration gets the same cards. The games are played
+    across a pool of workers processes (by default one per CPU), and the
+    tournament stops as soon as the SPRT decides whether config_a wins more
+    often than the 1 / players of an equal opponent, by delta.
+    """
+    seats = len(game_players(game, players))
+    p0 = 1.0 / seats
+    sprt = SPRT(p0, p0 + delta, alpha, beta)
+
+    rng = random.Random(seed)
+    num_deals = (max_games + seats - 1) // seats
+    jobs = [(game, players, deal_number, seat, deal_seed, rng.getrandbits(64),
+             config_a, config_b)
+            for deal_number, deal_seed in enumerate(rng.getrandbits(64) for d in xrange(num_deals))
+            for seat in xrange(seats)][:max_games]
+
+    pool = multiprocessing.Pool(workers)
+    wins = 0
+    games = 0
+    decision = None
+    try:
+        for deal_number, seat, result in pool.imap_unordered(play_game, jobs):
+            games += 1
+            wins += result
+            decision = sprt.decision(wins, games - wins)
+            if not quiet:
+                print "Game %i (deal %i, seat %i): %s - %s" % (
+                    games, deal_number, seat, "win" if result else "loss",
+                    TournamentResult(wins, games, sprt, decision))
+                sys.stdout.flush()
+            if decision is not None:
+                break
+    finally:
+        pool.terminate()
+    return TournamentResult(wins, games, sprt, decision)
+
+
+def parse_config(text):
+    """ Parse a configuration such as "itermax=1000,exploration=0.5,tree=array"
+        into a dictionary.
+    """
+    config = {}
+    for item in text.split(","):
+        name, value = item.split("=")
+        for convert in (int, float, str):
+            try:
+                config[name] = convert(value)
+                break
+            except ValueError:
+                pass
+    return config
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Play two ismcts configurations against each other.")
+    parser.add_argument("--a", type=parse_config, required=True, metavar="CONFIG",
+                        help="the configuration under test, e.g. itermax=1000,exploration=0.5")
+    parser.add_argument("--b", type=parse_config, required=True, metavar="CONFIG",
+                        help="the configuration to compare it with")
+    parser.add_argument("--game", choices=("president", "whist"), default="president")
+    parser.add_argument("--players", type=int, default=2,
+                        help="the number of players of Knockout Whist")
+    parser.add_argument("--games", type=int, default=1000, help="the most games to play")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--delta", type=float, default=0.05,
+                        help="the increase in win rate that the SPRT tests for")
+    args = parser.parse_args(argv)
+
+    print tournament(args.a, args.b, args.game, args.players, args.games, args.workers,
+                     args.seed, args.delta)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))